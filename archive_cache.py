@@ -0,0 +1,113 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+
+cache_directory = 'archive_cache'
+
+class ArchiveCache:
+    """
+    Local cache of raw Level II volumes, keyed by their S3 key.
+    Objects in `noaa-nexrad-level2` never change once written, so the key alone identifies the content.
+    Entries are written to a temp file and renamed into place, so a crash never leaves a partial volume
+    behind. Once the cache is over `max_bytes`, the least recently used volumes are evicted.
+    """
+
+    def __init__(self, directory=cache_directory, max_bytes=20 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = {}  # path -> (size, last used)
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith('.tmp'):  # Left over from an interrupted write
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            self._entries[path] = (stat.st_size, stat.st_mtime)
+            self._total_bytes += stat.st_size
+
+    def _path(self, key):
+        # Keep the original file name so the volume is still recognisable on disk
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{digest}_{os.path.basename(key)}")
+
+    def get(self, key):
+        """Returns the path of the cached volume for `key`, or None on a miss."""
+        path = self._path(key)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or not os.path.exists(path):
+                self._entries.pop(path, None)
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            os.utime(path)  # Persist recency so LRU order survives restarts
+            self._entries[path] = (entry[0], os.path.getmtime(path))
+            return path
+
+    def put_file(self, key, source_path):
+        """Moves a downloaded volume into the cache and returns its cached path."""
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=self.directory)
+        os.close(fd)
+        shutil.move(source_path, tmp_path)
+        return self._commit(tmp_path, self._path(key))
+
+    def put_bytes(self, key, data):
+        """Writes an in-memory volume into the cache and returns its cached path."""
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self._commit(tmp_path, self._path(key))
+
+    def _commit(self, tmp_path, path):
+        os.replace(tmp_path, path)  # Atomic on the same filesystem
+        size = os.path.getsize(path)
+
+        with self._lock:
+            old = self._entries.get(path)
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._entries[path] = (size, os.path.getmtime(path))
+            self._total_bytes += size
+            self._evict(keep=path)
+
+        return path
+
+    def _evict(self, keep=None):
+        # Must be called with the lock held
+        if self._total_bytes <= self.max_bytes:
+            return
+
+        for path, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del self._entries[path]
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+            }
@@ -0,0 +1,131 @@
+import os
+import io
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+basemap_directory = 'basemap_cache'
+
+_memory = OrderedDict()
+_lock = threading.Lock()
+_retry_after = 0.0  # time.monotonic() before which a failed draw isn't tried again
+max_memory_entries = 6  # Site overlays are about 20 MB each once decoded
+retry_interval = 300  # Seconds to render without map lines after a failed draw
+
+# Each radar site gets one overlay covering its 230 km range plus the widest plot buffer around it
+site_extent_degrees = 2.5  # Half-height; the half-width is stretched by 1 / cos(latitude)
+pixels_per_degree = 400
+line_width = 0.35  # Points; the crop of a plot extent is scaled up about 2x, to the width of a product's lines
+
+def _site_extent(site_lat, site_lon):
+    # (west, east, south, north) of a site's overlay, from its location rounded to 0.01 degrees
+    site_lat, site_lon = round(site_lat, 2), round(site_lon, 2)
+    half_width = site_extent_degrees / max(math.cos(math.radians(site_lat)), 0.1)
+    return site_lon - half_width, site_lon + half_width, site_lat - site_extent_degrees, site_lat + site_extent_degrees
+
+def _overlay_path(directory, site):
+    return os.path.join(directory, f"{site}_{pixels_per_degree}.png")
+
+def _draw_overlay(extent):
+    # Only the map lines on a transparent background, one pixel every 1 / pixels_per_degree degrees
+    import cartopy.crs as ccrs
+    from cartopy.feature import NaturalEarthFeature
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    west, east, south, north = extent
+    dpi = 100
+    fig = Figure(figsize=(round((east - west) * pixels_per_degree) / dpi, round((north - south) * pixels_per_degree) / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.PlateCarree())
+    ax.set_xlim([west, east])
+    ax.set_ylim([south, north])
+    ax.set_aspect('auto')
+
+    states = NaturalEarthFeature(category='cultural', scale='50m', facecolor='none', name='admin_1_states_provinces_lines')
+    ax.add_feature(states, edgecolor='black', linewidth=line_width)
+    ax.axis('off')
+    ax.gridlines(draw_labels=False, linewidth=line_width)
+    ax.coastlines('10m', linewidth=line_width)
+    ax.set_frame_on(False)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi, transparent=True)
+    buf.seek(0)
+    return buf.getvalue()
+
+def _site_overlay(site, extent, directory):
+    # A site's whole overlay, from memory, from `directory`, or drawn now; None if it can't be drawn
+    global _retry_after
+    with _lock:
+        if site in _memory:
+            _memory.move_to_end(site)
+            return _memory[site]
+
+    path = _overlay_path(directory, site)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+    elif time.monotonic() < _retry_after:
+        return None
+    else:
+        try:
+            data = _draw_overlay(extent)
+        except Exception as e:
+            # Usually the shapefiles aren't downloaded yet and there is no network. Don't retry every call, but
+            # do retry later, so a long-running service gets its map lines back once the network is
+            print(f"Basemap overlay unavailable, rendering without map lines for {retry_interval} s. Error: {e}")
+            _retry_after = time.monotonic() + retry_interval
+            return None
+
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    image = Image.open(io.BytesIO(data)).convert('RGBA')
+    image.load()
+    with _lock:
+        _memory[site] = image
+        while len(_memory) > max_memory_entries:
+            _memory.popitem(last=False)
+    return image
+
+def overlay(lat, lon, buffer_in_degrees, site, site_lat, site_lon, directory=basemap_directory):
+    """
+    Returns the state lines, gridlines and coastlines for a plot extent as an RGBA image, or None if they
+    can't be drawn. The lines are rasterized once per radar site, over its whole range, and kept in memory
+    and as a PNG in `directory`; every plot extent around the site is a crop of that image. Later calls for
+    any location the site covers, including ones without network access, never touch the Natural Earth
+    shapefiles again. Parts of the extent outside the site's overlay are left transparent.
+    """
+    extent = _site_extent(site_lat, site_lon)
+    image = _site_overlay(site or f"{round(site_lat, 2)}_{round(site_lon, 2)}", extent, directory)
+    if image is None:
+        return None
+
+    west, east, south, north = extent
+    scale_x = image.width / (east - west)
+    scale_y = image.height / (north - south)
+    return image.crop((
+        round((lon - buffer_in_degrees - west) * scale_x),
+        round((north - lat - buffer_in_degrees) * scale_y),
+        round((lon + buffer_in_degrees - west) * scale_x),
+        round((north - lat + buffer_in_degrees) * scale_y),
+    ))
+
+def composite(image_buffer, overlay_image):
+    """Draws a cached overlay on top of a rendered PNG and returns the result as a new PNG buffer."""
+    with Image.open(image_buffer) as img:
+        base = img.convert('RGBA')
+    if overlay_image.size != base.size:
+        overlay_image = overlay_image.resize(base.size, Image.LANCZOS)
+
+    result = io.BytesIO()
+    Image.alpha_composite(base, overlay_image).save(result, format='png')
+    result.seek(0)
+    return result
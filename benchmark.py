@@ -0,0 +1,278 @@
+import os
+import io
+import gzip
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import download
+import radar_io
+import raster
+import geometry_cache
+import visualize
+import cleanup
+import synthetic_radar
+from s3_standin import S3StandIn
+
+pyart = radar_io.import_pyart()
+
+# Radar served by the stand-in, at its real location
+benchmark_radar = ('KTLX', 35.333, -97.278)
+benchmark_day = datetime(2013, 5, 20)
+scan_interval_minutes = 5  # One key every 5 minutes makes a full day's listing the size of a real one
+
+all_stages = ['list', 'download', 'decompress', 'decode', 'render', 'resize_encode', 'pipeline', 'cleanup']
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', '-C', os.path.dirname(os.path.abspath(__file__)), 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _timed(fn, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+def _result(stage, seconds, items=1, batch_size=None, workers=None, nbytes=None, **extra):
+    median = statistics.median(seconds)
+    result = {
+        'stage': stage,
+        'batch_size': batch_size,
+        'workers': workers,
+        'repeats': len(seconds),
+        'seconds': seconds,
+        'median_s': median,
+        'min_s': min(seconds),
+        'per_item_s': median / items,
+    }
+    if nbytes is not None:
+        result['mb_per_s'] = nbytes / median / 1e6
+    result.update(extra)
+    label = ' '.join(f'{k}={v}' for k, v in (('batch', batch_size), ('workers', workers)) if v is not None)
+    label = ' '.join([str(v) for v in extra.values() if isinstance(v, str)] + [label])
+    print(f"  {stage:<14} {label:<32} {median * 1000:10.1f} ms  ({median / items * 1000:.1f} ms/item)")
+    return result
+
+def _scan_keys(radar_code, day):
+    keys = []
+    scan_time = day
+    while scan_time < day + timedelta(days=1):
+        keys.append(f"{scan_time:%Y/%m/%d}/{radar_code}/{radar_code}{scan_time:%Y%m%d_%H%M%S}_V06")
+        scan_time += timedelta(minutes=scan_interval_minutes)
+    return keys
+
+def _render_matplotlib(radar, sweep, lat, lon):
+    # The figure visualize_radar_data draws, saved to memory instead of disk
+    lats, lons = geometry_cache.gate_lat_lon(radar, sweep)
+    fig, ax = plt.subplots(figsize=(10, 10), subplot_kw={'projection': ccrs.PlateCarree()})
+    ax.pcolormesh(lons, lats, radar.get_field(sweep, 'velocity'), vmin=-60, vmax=60, cmap=pyart.graph.cm.NWSVel)
+    buffer_lat = 30.0 / 69.0
+    buffer_lon = 30.0 / (69.0 * np.cos(np.radians(lat)))
+    ax.set_xlim([lon - buffer_lon, lon + buffer_lon])
+    ax.set_ylim([lat - buffer_lat, lat + buffer_lat])
+    ax.axis('off')
+    image = io.BytesIO()
+    plt.savefig(image, bbox_inches='tight', pad_inches=0)
+    plt.close()
+    return image
+
+def _render_numpy(radar, sweep, lat, lon):
+    sweep_slice = radar.get_slice(sweep)
+    indices = raster.gate_indices(
+        radar.azimuth['data'][sweep_slice], radar.range['data'], radar.elevation['data'][sweep_slice].mean(),
+        radar.latitude['data'][0], radar.longitude['data'][0], lat, lon, 30.0 / 69.0
+    )
+    return raster.render_field(radar.get_field(sweep, 'velocity'), indices, raster.colormap_lut(pyart.graph.cm.NWSVel), -60, 60)
+
+def _resize_encode(png):
+    # The crop, resize and PNG encode at the end of visualize_radar_data
+    png.seek(0)
+    with Image.open(png) as img:
+        width, height = img.size
+        new_size = min(width, height)
+        img = img.crop(((width - new_size) / 2, (height - new_size) / 2, (width + new_size) / 2, (height + new_size) / 2))
+        img.resize((224, 224), Image.LANCZOS).save(io.BytesIO(), format='png')
+
+def _synthetic_tornadoes(path, rows, seed=0):
+    # Same columns cleanup.py reads from the SPC tornado CSV
+    rng = np.random.default_rng(seed)
+    years = rng.integers(1950, 2023, rows)
+    pd.DataFrame({
+        'om': np.arange(rows), 'yr': years, 'mo': rng.integers(1, 13, rows), 'dy': rng.integers(1, 29, rows),
+        'date': '', 'time': [f"{h:02}:{m:02}:00" for h, m in zip(rng.integers(0, 24, rows), rng.integers(0, 60, rows))],
+        'tz': 3, 'st': 'OK', 'mag': rng.integers(-1, 5, rows),
+        'slat': rng.uniform(25, 49, rows), 'slon': rng.uniform(-124, -67, rows),
+    }).to_csv(path, index=False)
+
+def run(batch_sizes=(4, 16), workers=(1, 4), render_workers=(1, 2), repeat=3, sweeps=8, fixture=None, latency=0.0, stages=all_stages, cleanup_rows=70000):
+    """
+    Times every pipeline stage against a local S3 stand-in holding synthetic (or fixture) Level II volumes,
+    so runs are repeatable and never touch the NOAA bucket. Returns the report as a dict.
+    """
+    workdir = tempfile.mkdtemp(prefix='nexrad_benchmark_')
+    standin = S3StandIn(latency=latency).start()
+    previous_endpoint = download.s3_endpoint_url
+    download.set_endpoint_url(standin.url)
+
+    try:
+        # One volume, served under every scan time of the day
+        radar_code, lat, lon = benchmark_radar
+        if fixture:
+            with open(fixture, 'rb') as f:
+                volume = f.read()
+            if fixture.endswith('.gz'):
+                volume = gzip.decompress(volume)
+        else:
+            volume = synthetic_radar.synthetic_volume(radar_code, benchmark_day, lat, lon, n_sweeps=sweeps)
+
+        keys = _scan_keys(radar_code, benchmark_day)
+        for key in keys:
+            standin.put(download.bucket_name, key, volume)
+
+        s3 = download.get_s3_client(max_pool_connections=max(max(workers), 10))
+        results = []
+        print(f"Volume: {len(volume) / 1e6:.1f} MB, {len(keys)} scans per radar-day, stand-in at {standin.url}")
+
+        if 'list' in stages:
+            prefix = f"{benchmark_day:%Y/%m/%d}/{radar_code}"
+            results.append(_result('list', _timed(lambda: download.list_files(download.bucket_name, prefix, s3), repeat), keys=len(keys)))
+
+        if 'download' in stages:
+            for batch_size in batch_sizes:
+                for count in workers:
+                    batch = keys[:batch_size]
+                    def fetch():
+                        with ThreadPoolExecutor(max_workers=count) as executor:
+                            list(executor.map(lambda key: download.download_selected_files_to_memory([key], download.bucket_name, s3), batch))
+                    results.append(_result('download', _timed(fetch, repeat), len(batch), batch_size, count, nbytes=len(volume) * len(batch)))
+
+        if 'decompress' in stages:
+            compressed = gzip.compress(volume)
+            results.append(_result('decompress', _timed(lambda: gzip.decompress(compressed), repeat), nbytes=len(volume)))
+
+        if 'decode' in stages:
+            results.append(_result('decode', _timed(lambda: radar_io.read_sweeps(io.BytesIO(volume), [3], ['velocity']), repeat), variant='selected_sweep'))
+            results.append(_result('decode', _timed(lambda: pyart.io.read_nexrad_archive(io.BytesIO(volume)), repeat), variant='full_volume'))
+
+        radar, sweep_map = radar_io.read_sweeps(io.BytesIO(volume), [3], ['velocity'])
+        tornado_lat, tornado_lon = lat + 0.5, lon + 0.5
+        if 'render' in stages:
+            results.append(_result('render', _timed(lambda: _render_matplotlib(radar, sweep_map[3], tornado_lat, tornado_lon), repeat), engine='matplotlib'))
+            results.append(_result('render', _timed(lambda: _render_numpy(radar, sweep_map[3], tornado_lat, tornado_lon), repeat), engine='numpy'))
+
+        if 'resize_encode' in stages:
+            png = _render_matplotlib(radar, sweep_map[3], tornado_lat, tornado_lon)
+            results.append(_result('resize_encode', _timed(lambda: _resize_encode(png), repeat), engine='matplotlib'))
+            image = _render_numpy(radar, sweep_map[3], tornado_lat, tornado_lon)
+            results.append(_result('resize_encode', _timed(lambda: Image.fromarray(image).save(io.BytesIO(), format='png'), repeat), engine='numpy'))
+
+        if 'pipeline' in stages:
+            # visualize_files end to end (decode, render, resize and save) on volumes already on disk
+            path = os.path.join(workdir, f"{radar_code}{benchmark_day:%Y%m%d_%H%M%S}_V06")
+            with open(path, 'wb') as f:
+                f.write(volume)
+            image_directory = os.path.join(workdir, 'images')
+            os.makedirs(image_directory, exist_ok=True)
+            for engine in ('matplotlib', 'numpy'):
+                for batch_size in batch_sizes:
+                    for count in render_workers:
+                        tasks = [(path, image_directory, tornado_lat, tornado_lon, {'engine': engine, 'event_id': i}) for i in range(batch_size)]
+                        seconds = _timed(lambda: visualize.visualize_files(tasks, workers=count), repeat)
+                        results.append(_result('pipeline', seconds, batch_size, batch_size, count, engine=engine))
+
+        if 'cleanup' in stages:
+            cwd = os.getcwd()
+            shutil.copy(cleanup.radar_csv, os.path.join(workdir, cleanup.radar_csv))
+            _synthetic_tornadoes(os.path.join(workdir, cleanup.tornado_csv), cleanup_rows)
+            os.chdir(workdir)
+            try:
+                results.append(_result('cleanup', _timed(lambda: cleanup.cleanup_tornado_data(force=True), repeat), cleanup_rows, rows=cleanup_rows))
+            finally:
+                os.chdir(cwd)
+
+        return {
+            'commit': _git_commit(),
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'volume_bytes': len(volume),
+            'fixture': fixture,
+            'sweeps': sweeps if not fixture else None,
+            'latency_s': latency,
+            's3_requests': dict(standin.stats),
+            'results': results,
+        }
+    finally:
+        download.set_endpoint_url(previous_endpoint)
+        standin.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def _result_key(result):
+    return (result['stage'], result['batch_size'], result['workers'], result.get('engine'), result.get('variant'))
+
+def compare(report, baseline):
+    # Side by side medians of the stages both reports measured; ratio > 1 means this run is slower
+    baseline_results = {_result_key(r): r for r in baseline['results']}
+    print(f"\nCompared with {baseline.get('commit')} ({baseline.get('created')}):")
+    for result in report['results']:
+        before = baseline_results.get(_result_key(result))
+        if before is None:
+            continue
+        label = ' '.join(str(part) for part in _result_key(result) if part is not None)
+        ratio = result['median_s'] / before['median_s']
+        print(f"  {label:<36} {before['median_s'] * 1000:10.1f} ms -> {result['median_s'] * 1000:10.1f} ms  x{ratio:.2f}")
+
+def _int_list(value):
+    return tuple(int(v) for v in value.split(','))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the download and render pipeline against a local S3 stand-in')
+    parser.add_argument('--batch-sizes', type=_int_list, default=(4, 16), help='Comma separated batch sizes, e.g. 4,16')
+    parser.add_argument('--workers', type=_int_list, default=(1, 4), help='Comma separated download worker counts')
+    parser.add_argument('--render-workers', type=_int_list, default=(1, 2), help='Comma separated render worker counts')
+    parser.add_argument('--repeat', type=int, default=3, help='Times each measurement is repeated (the median is reported)')
+    parser.add_argument('--sweeps', type=int, default=8, help='Sweeps in each synthetic volume')
+    parser.add_argument('--fixture', help='Use this Level II file (optionally .gz) instead of synthetic volumes')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of delay the stand-in adds to each S3 request')
+    parser.add_argument('--stages', default=','.join(all_stages), help='Comma separated stages to run')
+    parser.add_argument('--cleanup-rows', type=int, default=70000, help='Rows in the synthetic tornado CSV')
+    parser.add_argument('--quick', action='store_true', help='One repeat of small batches, for a fast check')
+    parser.add_argument('--output', help='Report path (default benchmark_results/<commit>-<time>.json)')
+    parser.add_argument('--compare', help='Earlier report to compare against')
+
+    args = parser.parse_args()
+
+    if args.quick:
+        args.batch_sizes, args.workers, args.render_workers, args.repeat, args.cleanup_rows = (2,), (1, 2), (1,), 1, 5000
+
+    report = run(args.batch_sizes, args.workers, args.render_workers, args.repeat, args.sweeps, args.fixture, args.latency, args.stages.split(','), args.cleanup_rows)
+
+    output = args.output or os.path.join('benchmark_results', f"{report['commit'] or 'nogit'}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
@@ -1,70 +1,75 @@
 # Importing necessary libraries
-import os
+# pyart, matplotlib, cartopy, scipy and boto3 are imported where they are first needed,
+# so importing this module (or running --help) stays fast
 import io
-import sys
 import gzip
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
 from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.spatial import KDTree
-import cartopy.crs as ccrs
-from cartopy.feature import NaturalEarthFeature
-import numpy as np
 from PIL import Image
 import argparse
 import base64
-
-backup = sys.stdout
-sys.stdout = open(os.devnull, 'w')
-import pyart
-sys.stdout = backup
+import basemap
+import geometry_cache
+import radar_io
+import radar_index
+import s3_controller
 
 # Constants
 bucket_name = 'noaa-nexrad-level2'
+buffer_in_degrees = 30.0 / 69.0  # 30 miles to degrees
+
+def radar_sites():
+    # The geodesic radar index over radar_locations.csv, loaded on first use
+    return radar_index.default_index()
 
-radar_df = pd.read_csv('radar_locations.csv')
-radar_points = list(zip(radar_df['Latitude'], radar_df['Longitude']))
-kdtree = KDTree(radar_points)
+def nearby_radar_sites(lat, lon):
+    # Radar sites covering the location, nearest first (the nearest is always included)
+    return [code for code, _ in radar_sites().candidates(lat, lon)[0]]
 
 def find_nearest_radar_site(lat, lon):
     # Find the nearest radar site to the provided latitude and longitude
-    radar_site = kdtree.query([lat, lon])[1]
-    return radar_df.iloc[radar_site]['RadarCode']
-
-def list_files(bucket_name, prefix):
-    # List all files in the provided S3 bucket and prefix
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    results = []
+    return nearby_radar_sites(lat, lon)[0]
+
+def _default_client():
+    # Retries are left to s3_controller
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.client import Config
+    return boto3.client('s3', config=Config(signature_version=UNSIGNED, retries={'mode': 'standard', 'total_max_attempts': 1}))
+
+def list_files(bucket_name, prefix, s3=None, start_after=None):
+    # List all files in the provided S3 bucket and prefix, optionally only those after a known key
+    s3 = s3 or _default_client()
     paginator = s3.get_paginator('list_objects_v2')
-    
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        for content in page.get('Contents', []):
-            results.append(content['Key'])
+    extra = {'StartAfter': start_after} if start_after else {}
+
+    def list_all():
+        return [content['Key'] for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, **extra) for content in page.get('Contents', [])]
      
-    return results
+    return s3_controller.call('list', list_all)
 
 
-def find_most_recent_file(bucket_name, radar_site):
+def find_most_recent_file(bucket_name, radar_site, s3=None):
     # Find the most recent radar file for the provided radar site
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    files = list_files(bucket_name, radar_site)
+    files = list_files(bucket_name, radar_site, s3)
+    if not files:
+        return None
     # return the most recent file from the list
     print("File Path: " + files[-1])
     return files[-1]
 
 # Download the most recent radar file for the provided radar site
-def download_and_decompress(filename):
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+def download_and_decompress(filename, s3=None):
+    s3 = s3 or _default_client()
 
-    # Using BytesIO to handle the file content in memory
-    compressed_file_obj = io.BytesIO()
+    def download():
+        # Using BytesIO to handle the file content in memory, a new one for every attempt
+        buffer = io.BytesIO()
+        s3.download_fileobj(bucket_name, filename, buffer)
+        return buffer
 
     try:
-        # Download the file directly into memory
-        s3.download_fileobj(bucket_name, filename, compressed_file_obj)
+        # Download the file directly into memory, retrying transient errors
+        compressed_file_obj = s3_controller.call('download', download)
 
         # If the file is a gzip, decompress it
         if filename.endswith(".gz"):
@@ -82,104 +87,76 @@ def download_and_decompress(filename):
         return None
 
 
+def _plot_product(lons, lats, data, vmin, vmax, cmap, lat, lon):
+    # Each product gets its own Figure instead of pyplot's global state
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import cartopy.crs as ccrs
+
+    fig = Figure(figsize=(10, 10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(projection=ccrs.PlateCarree())
+    ax.pcolormesh(lons, lats, data, vmin=vmin, vmax=vmax, cmap=cmap)
+
+    # Setting the plot extent
+    ax.set_xlim([lon - buffer_in_degrees, lon + buffer_in_degrees])
+    ax.set_ylim([lat - buffer_in_degrees, lat + buffer_in_degrees])
+
+    ax.axis('off')
+
+    # Save the plot to a BytesIO object
+    img = io.BytesIO()
+    fig.savefig(img, format='png', bbox_inches='tight', pad_inches=0)
+    img.seek(0)  # Go back to the beginning of the BytesIO object
+    return img
+
+def _radar_site(radar):
+    # (code, latitude, longitude) of the radar that recorded a volume
+    code = radar.metadata.get('instrument_name', '')
+    if isinstance(code, bytes):
+        code = code.decode('ascii', 'ignore')
+    return code.strip(), float(radar.latitude['data'][0]), float(radar.longitude['data'][0])
+
+def _plot_reflectivity(lons, lats, data, lat, lon, site):
+    pyart = radar_io.import_pyart()
+    reflectivity_img = _plot_product(lons, lats, data, -32, 64, pyart.graph.cm.NWSRef, lat, lon)
+
+    # State lines, gridlines and coastlines are cropped from the radar site's cached, pre-rasterized overlay
+    overlay = basemap.overlay(lat, lon, buffer_in_degrees, *site)
+    if overlay is None:
+        return reflectivity_img
+    return basemap.composite(reflectivity_img, overlay)
+
 # Visualizing the radar data
 def visualize_radar_data(weather_data, lat, lon):
 
-    # Read the radar data
-    radar = pyart.io.read_nexrad_archive(weather_data)
+    # Read the radar data once, decoding only the sweeps and fields plotted below
+    radar, sweep_map = radar_io.read_sweeps(weather_data, [0, 3], ['velocity', 'reflectivity'])
 
     if 'velocity' not in radar.fields:
         print(f"Error processing {weather_data}. Velocity data is missing.")
         return
 
-    # Extracting the data for velocity
-    sweep = 3  # Adjust the sweep index as needed
+    # Extracting the data for velocity and reflectivity
+    sweep = sweep_map[3]  # Adjust the sweep index as needed
     data = radar.get_field(sweep, 'velocity')
-    x, y, _ = radar.get_gate_x_y_z(sweep)
-    x /= 1000.0  # Convert to km
-    y /= 1000.0  # Convert to km
-
-    # Convert Cartesian x and y to latitudes and longitudes
-    lon_offset = x / (111.0 * np.cos(np.radians(radar.latitude['data'][0])))
-    lat_offset = y / 111.0
-    actual_lons = radar.longitude['data'][0] + lon_offset
-    actual_lats = radar.latitude['data'][0] + lat_offset
-
-    # Create the plot
-    fig, ax = plt.subplots(figsize=(10, 10), subplot_kw={'projection': ccrs.PlateCarree()})
-    ax.pcolormesh(actual_lons, actual_lats, data, vmin=-60, vmax=60, cmap=pyart.graph.cm.NWSVel)
-
-    # Setting the plot extent
-    buffer_in_degrees = 30.0 / 69.0  # 30 miles to degrees
-    ax.set_xlim([lon - buffer_in_degrees, lon + buffer_in_degrees])
-    ax.set_ylim([lat - buffer_in_degrees, lat + buffer_in_degrees])
-
-    ax.axis('off')
-
-    # Save the velocity plot to a BytesIO object
-    velocity_img = io.BytesIO()
-    plt.savefig(velocity_img, format='png', bbox_inches='tight', pad_inches=0)
-    velocity_img.seek(0)  # Go back to the beginning of the BytesIO object
-    plt.close(fig)
+    actual_lats, actual_lons = geometry_cache.gate_lat_lon(radar, sweep)
 
-     # ------ Reflectivity Plot ------
-    sweep_reflectivity = 0  # Adjust the sweep index as needed for reflectivity
+    sweep_reflectivity = sweep_map[0]  # Adjust the sweep index as needed for reflectivity
     data_reflectivity = radar.get_field(sweep_reflectivity, 'reflectivity')
-    x_reflectivity, y_reflectivity, _ = radar.get_gate_x_y_z(sweep_reflectivity)
-    x_reflectivity /= 1000.0  # Convert to km
-    y_reflectivity /= 1000.0  # Convert to km
-
-    # Convert Cartesian x and y to latitudes and longitudes for reflectivity
-    lon_offset_reflectivity = x_reflectivity / (111.0 * np.cos(np.radians(radar.latitude['data'][0])))
-    lat_offset_reflectivity = y_reflectivity / 111.0
-    actual_lons_reflectivity = radar.longitude['data'][0] + lon_offset_reflectivity
-    actual_lats_reflectivity = radar.latitude['data'][0] + lat_offset_reflectivity
-
-    # Create the reflectivity plot
-    fig2, ax2 = plt.subplots(figsize=(10, 10), subplot_kw={'projection': ccrs.PlateCarree()})
-    ax2.pcolormesh(actual_lons_reflectivity, actual_lats_reflectivity, data_reflectivity, vmin=-32, vmax=64, cmap=pyart.graph.cm.NWSRef)
-
-    # Setting the plot extent similar to the first plot
-    ax2.set_xlim([lon - buffer_in_degrees, lon + buffer_in_degrees])
-    ax2.set_ylim([lat - buffer_in_degrees, lat + buffer_in_degrees])
-
-    # Adding state lines
-    states = NaturalEarthFeature(category='cultural', scale='50m', facecolor='none', name='admin_1_states_provinces_lines')
-    ax2.add_feature(states, edgecolor='black')
-
-    # Remove axis, gridlines, coastlines, and frame for reflectivity plot
-    ax2.axis('off')
-    ax2.gridlines(draw_labels=False)
-    ax2.coastlines('10m', linewidth=0.8)
-    ax2.set_frame_on(False)
-
-    # Save the reflectivity plot to a BytesIO object
-    reflectivity_img = io.BytesIO()
-    plt.savefig(reflectivity_img, format='png', bbox_inches='tight', pad_inches=0)
-    reflectivity_img.seek(0)  # Go back to the beginning of the BytesIO object
-    plt.close(fig2)
+    actual_lats_reflectivity, actual_lons_reflectivity = geometry_cache.gate_lat_lon(radar, sweep_reflectivity)
 
+    # Rendered one after the other: both are CPU bound and hold the GIL, so threads only add overhead
+    pyart = radar_io.import_pyart()
+    velocity_img = _plot_product(actual_lons, actual_lats, data, -60, 60, pyart.graph.cm.NWSVel, lat, lon)
+    reflectivity_img = _plot_reflectivity(actual_lons_reflectivity, actual_lats_reflectivity, data_reflectivity, lat, lon, _radar_site(radar))
     return velocity_img, reflectivity_img
 
 def encode_image(image_buffer):
     return base64.b64encode(image_buffer.getvalue()).decode('utf-8')
 
-def main(lat, lon):
-    # Take the users latitude and longitude and find the nearest radar
-    radar_site = find_nearest_radar_site(lat, lon)
-    print("Radar Site: " + radar_site)
-
-    # Create a prefix with the radar site using the current date time
-    now = datetime.utcnow() # Using UTC because that's what NEXRAD expects
-
-    prefix = f'{now.year}/{now.month:02}/{now.day:02}/{radar_site}'
-
-    filename = find_most_recent_file(bucket_name, prefix)
-
-    # Download the radar file
-    decompressed_data = download_and_decompress(filename)
-
-    # Visualize the radar file
+def render_images(decompressed_data, lat, lon):
+    # Render both products for a downloaded volume and return them base64 encoded
     velocity_img, reflectivity_img = visualize_radar_data(decompressed_data, lat, lon)
 
     # Display the velocity plot
@@ -195,6 +172,30 @@ def main(lat, lon):
 
     return encoded_velocity_img, encoded_reflectivity_img
 
+def main(lat, lon):
+    # Take the users latitude and longitude and find the nearest radar with data today
+    now = datetime.utcnow() # Using UTC because that's what NEXRAD expects
+
+    for radar_site in nearby_radar_sites(lat, lon):
+        print("Radar Site: " + radar_site)
+
+        # Create a prefix with the radar site using the current date time
+        prefix = f'{now.year}/{now.month:02}/{now.day:02}/{radar_site}'
+
+        filename = find_most_recent_file(bucket_name, prefix)
+        if filename:
+            break
+        print(f"No data from {radar_site} today, trying the next nearest radar.")
+    else:
+        print("No radar near this location has data today.")
+        return None
+
+    # Download the radar file
+    decompressed_data = download_and_decompress(filename)
+
+    # Visualize the radar file
+    return render_images(decompressed_data, lat, lon)
+
 if __name__ == "__main__":
     # Example latitude and longitude
     parser = argparse.ArgumentParser(description='Get latitude and longitude')
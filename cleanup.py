@@ -1,73 +1,87 @@
+import os
+import hashlib
+import numpy as np
 import pandas as pd
-from scipy.spatial import KDTree
-
-from datetime import datetime, timedelta
-
-def adjust_to_gmt(row):
-    """Adjust the time to GMT based on the timezone."""
-    hour, minute, _ = map(int, row['time'].split(':'))
-    tz = row['tz']
-    # Assume dy, mo, yr represent day, month, year respectively in `row`
-    day = row['dy']
-    month = row['mo']
-    year = row['yr']
-
-    # Create a datetime object with the local time
-    local_time = datetime(year, month, day, hour, minute)
-
-    if tz == 3:  # CST is 6 hours behind GMT
-        # Use timedelta to adjust the time
-        adjusted_time = local_time + timedelta(hours=6)
-    elif tz == '?':  # Unknown timezone, we exclude this data
+import radar_index
+
+tornado_csv = '1950-2022_all_tornadoes.csv'
+radar_csv = 'radar_locations.csv'
+enriched_csv = 'enriched_tornado_data.csv'
+# Hash of the inputs the current enriched_tornado_data.csv was built from
+hash_file = enriched_csv + '.sha256'
+# Bump this when the cleanup logic changes so existing outputs get rebuilt
+cleanup_version = '3'
+
+def adjust_to_gmt_columns(df):
+    """Adjusts the date and time columns to GMT based on the timezone; raises ValueError for unknown timezones."""
+    if (df['tz'].astype(str) == '?').any():  # Unknown timezone, we exclude this data
         raise ValueError("Unknown timezone")
-    else:
-        # If there are other time zones, you would handle them here
-        adjusted_time = local_time
 
-    # Update the row with the adjusted time values
-    row['dy'] = adjusted_time.day
-    row['mo'] = adjusted_time.month
-    row['yr'] = adjusted_time.year
-    row['time'] = adjusted_time.strftime("%H:%M:%S")
-
-    return row
-
-
-def cleanup_tornado_data():
-    # Load the radar station data
-    radar_df = pd.read_csv('radar_locations.csv')
-    radar_points = list(zip(radar_df['Latitude'], radar_df['Longitude']))
-
-    # Create a k-d tree for the radar stations
-    kdtree = KDTree(radar_points)
+    time_parts = df['time'].str.split(':', expand=True).astype(int)
+    local_time = pd.to_datetime(pd.DataFrame({
+        'year': df['yr'], 'month': df['mo'], 'day': df['dy'],
+        'hour': time_parts[0], 'minute': time_parts[1],
+    }))
+
+    # CST (tz 3) is 6 hours behind GMT, other time zones are left as they are
+    adjusted_time = local_time + pd.to_timedelta(np.where(df['tz'] == 3, 6, 0), unit='h')
+
+    df = df.copy()
+    df['dy'] = adjusted_time.dt.day
+    df['mo'] = adjusted_time.dt.month
+    df['yr'] = adjusted_time.dt.year
+    df['time'] = adjusted_time.dt.strftime("%H:%M:%S")
+    return df
+
+def _inputs_hash():
+    digest = hashlib.sha256(cleanup_version.encode())
+    for path in (tornado_csv, radar_csv):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def cleanup_tornado_data(force=False):
+    # Skip the rebuild when the output was already made from these exact inputs
+    if not force and os.path.exists(enriched_csv) and not os.path.exists(tornado_csv):
+        print(f"{tornado_csv} not found, using the existing {enriched_csv}.")
+        return
+
+    inputs_hash = _inputs_hash()
+    if not force and os.path.exists(enriched_csv) and os.path.exists(hash_file):
+        with open(hash_file) as f:
+            if f.read().strip() == inputs_hash:
+                return
+
+    # Geodesic index of the radar stations (scipy is only needed for a rebuild)
+    radars = radar_index.RadarIndex(radar_csv)
 
     # Load tornado data
-    tornado_df = pd.read_csv('1950-2022_all_tornadoes.csv')
+    tornado_df = pd.read_csv(tornado_csv)
 
     # Filter out tornado data before a certain year, e.g., 2010
     filtered_data = tornado_df[tornado_df['yr'] >= 2011]
 
     # Adjust time to GMT
     try:
-        filtered_data = filtered_data.apply(adjust_to_gmt, axis=1)
+        filtered_data = adjust_to_gmt_columns(filtered_data)
     except ValueError as ve:
         print(f"Error adjusting to GMT: {ve}")
 
-    # For each tornado location in the filtered_data, find the nearest radar station
-    nearest_radars = []
-    for idx, row in filtered_data.iterrows():
-        _, index = kdtree.query((row['slat'], row['slon']))
-        nearest_radar = radar_df.iloc[index]
-        nearest_radars.append(nearest_radar['RadarCode'])
+    # Find the nearest radar stations for every tornado location in one query
+    candidates = radars.candidates(filtered_data['slat'].to_numpy(), filtered_data['slon'].to_numpy())
 
-    # Add the nearest radar station ID to the filtered_data DataFrame
-    filtered_data.loc[:, 'Nearest Radar Station'] = nearest_radars
+    # Add the nearest radar station ID, and the nearby stations to fall back on, to the filtered_data DataFrame
+    filtered_data.loc[:, 'Nearest Radar Station'] = [row[0][0] for row in candidates]
+    filtered_data.loc[:, 'Candidate Radars'] = radar_index.format_candidates(candidates)
 
     # Filter out tornadoes with magnitude less than 1
     filtered_data = filtered_data[filtered_data['mag'] > 1]
 
     # Save the enriched filtered_data to a new CSV
-    filtered_data.to_csv('enriched_tornado_data.csv', index=False)
+    filtered_data.to_csv(enriched_csv, index=False)
+    with open(hash_file, 'w') as f:
+        f.write(inputs_hash)
 
 # For standalone execution
 if __name__ == '__main__':
@@ -1,28 +1,84 @@
 import os
 import gzip
 import shutil
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
 from datetime import datetime
+import io
 import re
-import pandas as pd
+import threading
+import instrumentation
+import partial_fetch
+import s3_controller
 
 bucket_name = 'noaa-nexrad-level2'
 compressed_dir = "./compressed_files"
 uncompressed_dir = "./uncompressed_files"
 
-def list_files(bucket_name, prefix):
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    results = []
+# Point this at a local S3 stand-in (e.g. `moto_server`) to run without the live NOAA bucket
+s3_endpoint_url = os.environ.get('NEXRAD_S3_ENDPOINT_URL')
+
+_s3_client = None
+_s3_pool_size = 0
+_s3_client_lock = threading.Lock()
+
+def get_s3_client(max_pool_connections=10):
+    """
+    Returns the shared anonymous S3 client, building it on first use.
+    boto3 clients are thread safe, so one client (and its connection pool) is reused
+    by every download instead of paying a new handshake per call. botocore's own retries are
+    off; calls go through s3_controller, which retries them and paces the whole run.
+    """
+    global _s3_client, _s3_pool_size
+
+    with _s3_client_lock:
+        if _s3_client is None or _s3_pool_size < max_pool_connections:
+            # boto3 is imported here, so commands that never reach S3 don't pay for it
+            import boto3
+            from botocore import UNSIGNED
+            from botocore.client import Config
+
+            config = Config(signature_version=UNSIGNED, max_pool_connections=max_pool_connections, retries={'mode': 'standard', 'total_max_attempts': 1})
+            _s3_client = boto3.client('s3', config=config, endpoint_url=s3_endpoint_url)
+            _s3_pool_size = max_pool_connections
+        return _s3_client
+
+def set_endpoint_url(url):
+    # Switches every later call to another S3 endpoint (None for AWS), e.g. a stand-in started at runtime
+    global s3_endpoint_url, _s3_client
+
+    with _s3_client_lock:
+        s3_endpoint_url = url
+        _s3_client = None
+
+def list_files(bucket_name, prefix, s3=None):
+    s3 = s3 or get_s3_client()
     paginator = s3.get_paginator('list_objects_v2')
+
+    def list_all():
+        # A retry starts the listing over, so a failed page never leaves a gap
+        return [content['Key'] for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix) for content in page.get('Contents', [])]
     
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        for content in page.get('Contents', []):
-            results.append(content['Key'])
+    with instrumentation.stage('list', source=prefix) as record:
+        results = s3_controller.call('list', list_all)
+        record['keys'] = len(results)
     
     return results
 
+def list_radars(bucket_name, year, month, day, s3=None):
+    # Radars with data on a day, from the common prefixes of one delimited listing of the day
+    s3 = s3 or get_s3_client()
+    prefix = f'{year}/{month:02}/{day:02}/'
+    paginator = s3.get_paginator('list_objects_v2')
+
+    def list_all():
+        pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/')
+        return {common_prefix['Prefix'][len(prefix):].strip('/') for page in pages for common_prefix in page.get('CommonPrefixes', [])}
+
+    with instrumentation.stage('list', source=prefix) as record:
+        radars = s3_controller.call('list', list_all)
+        record['keys'] = len(radars)
+
+    return radars
+
 def extract_datetime_from_filename(filename):
     base_filename = os.path.basename(filename)
     pattern = r'(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})'
@@ -56,8 +112,11 @@ def filter_files_based_on_time(files, start_time):
     #return filtered_files
     return []
 
-def download_selected_files(files, bucket_name, compressed_dir, uncompressed_dir):
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+def download_selected_files(files, bucket_name, compressed_dir, uncompressed_dir, s3=None, cache=None, last_sweep=None):
+    # When an archive_cache.ArchiveCache is given, volumes are read from it when present and
+    # stored in it after download instead of being left in compressed_dir.
+    # With last_sweep set, volumes not in the cache are fetched only up to the end of that sweep (see partial_fetch.py)
+    s3 = s3 or get_s3_client()
     downloaded_files_list = []
 
     for file in files:
@@ -69,49 +128,99 @@ def download_selected_files(files, bucket_name, compressed_dir, uncompressed_dir
         os.makedirs(compressed_dir, exist_ok=True)
 
         try:
-            # Download the file
-            s3.download_file(bucket_name, file, compressed_path)
+            cached_path = cache.get(file) if cache is not None else None
+            if cached_path is None and last_sweep is not None:
+                # Partial volumes stay out of the archive cache, which only holds whole objects
+                volume = partial_fetch.fetch_sweeps(s3, bucket_name, file, last_sweep)
+                if volume is not None:
+                    uncompressed_path = os.path.join(uncompressed_dir, actual_file[:-len('.gz')] if actual_file.endswith('.gz') else actual_file)
+                    with open(uncompressed_path, 'wb') as f:
+                        f.write(volume)
+                    downloaded_files_list.append(uncompressed_path)
+                    continue
+            if cached_path is None:
+                # Download the file
+                with instrumentation.stage('download', source=file) as record:
+                    s3_controller.call('download', s3.download_file, bucket_name, file, compressed_path)
+                    record['bytes'] = os.path.getsize(compressed_path)
+                if cache is not None:
+                    cached_path = cache.put_file(file, compressed_path)
+            source_path = cached_path or compressed_path
             
             # If the file is a gzip, uncompress it and store in uncompressed_dir
             if actual_file.endswith(".gz"):
                 uncompressed_file = actual_file.rstrip('.gz')
                 uncompressed_path = os.path.join(uncompressed_dir, uncompressed_file)
                 
-                with gzip.open(compressed_path, 'rb') as f_in:
-                    with open(uncompressed_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                #os.remove(compressed_path)  # Remove the gz file after decompressing
+                with instrumentation.stage('decompress', source=file) as record:
+                    with gzip.open(source_path, 'rb') as f_in:
+                        with open(uncompressed_path, 'wb') as f_out:
+                            shutil.copyfileobj(f_in, f_out)
+                    record['bytes'] = os.path.getsize(uncompressed_path)
+                if not cached_path:
+                    os.remove(compressed_path)  # Remove the gz file after decompressing
                 downloaded_files_list.append(uncompressed_path)
             else:
-                # If not a gzip, simply move it to the uncompressed_dir
-                shutil.move(compressed_path, os.path.join(uncompressed_dir, actual_file))
+                # If not a gzip, simply move it to the uncompressed_dir (copy it when it belongs to the cache)
+                if cached_path:
+                    shutil.copyfile(cached_path, os.path.join(uncompressed_dir, actual_file))
+                else:
+                    shutil.move(compressed_path, os.path.join(uncompressed_dir, actual_file))
                 downloaded_files_list.append(os.path.join(uncompressed_dir, actual_file))
         except Exception as e:
             print(f"Failed to download and process file {file}. Error: {e}")
 
     return downloaded_files_list
 
-def main_download_proccess(year, month, day, radar_code, start_time, compressed_dir='compressed_files', uncompressed_dir='uncompressed_files'):
-    # Ensure the output directories exist
-    try:
-        if not os.path.exists(compressed_dir):
-            os.makedirs(compressed_dir)
-        if not os.path.exists(uncompressed_dir):
-            os.makedirs(uncompressed_dir)
-    except OSError as e:
-        if e.errno != 17:
-            raise
-        
-    prefix = f'{year}/{month:02}/{day:02}/{radar_code}'
+def _download_to_memory(s3, bucket_name, file):
+    # A fresh buffer per attempt, so a retry never appends to a partial download
+    buffer = io.BytesIO()
+    s3.download_fileobj(bucket_name, file, buffer)
+    return buffer
 
-    files = list_files(bucket_name, prefix)
+def download_selected_files_to_memory(files, bucket_name, s3=None, cache=None, last_sweep=None):
+    """
+    Streaming counterpart of download_selected_files: each file is fetched into memory and
+    gunzipped there, nothing is written to disk. Returns BytesIO buffers positioned at the start,
+    each with a `name` attribute set to the decompressed file name so it can be used for output names.
+    `last_sweep` fetches only the start of each volume, as in download_selected_files.
+    """
+    s3 = s3 or get_s3_client()
+    buffers = []
 
-    if not files:
-        print(f"No files found for {radar_code} on {year}-{month:02}-{day:02}.")
-        return []
-    
-    selected_files = filter_files_based_on_time(files, start_time)
+    for file in files:
+        actual_file = os.path.basename(file)  # Get the filename from the S3 key
 
-    downloaded_files = download_selected_files(selected_files, bucket_name, compressed_dir, uncompressed_dir)
+        try:
+            cached_path = cache.get(file) if cache is not None else None
+            if cached_path is None and last_sweep is not None:
+                volume = partial_fetch.fetch_sweeps(s3, bucket_name, file, last_sweep)
+                if volume is not None:
+                    buffer = io.BytesIO(volume)
+                    buffer.name = actual_file[:-len('.gz')] if actual_file.endswith('.gz') else actual_file
+                    buffers.append(buffer)
+                    continue
+            if cached_path is not None:
+                with open(cached_path, 'rb') as f:
+                    compressed_file_obj = io.BytesIO(f.read())
+            else:
+                with instrumentation.stage('download', source=file) as record:
+                    compressed_file_obj = s3_controller.call('download', _download_to_memory, s3, bucket_name, file)
+                    record['bytes'] = compressed_file_obj.getbuffer().nbytes
+                if cache is not None:
+                    cache.put_bytes(file, compressed_file_obj.getbuffer())
+
+            if actual_file.endswith(".gz"):
+                with instrumentation.stage('decompress', source=file) as record:
+                    buffer = io.BytesIO(gzip.decompress(compressed_file_obj.getbuffer()))
+                    record['bytes'] = buffer.getbuffer().nbytes
+                buffer.name = actual_file[:-len('.gz')]
+            else:
+                buffer = compressed_file_obj
+                buffer.seek(0)
+                buffer.name = actual_file
+            buffers.append(buffer)
+        except Exception as e:
+            print(f"Failed to download and process file {file}. Error: {e}")
 
-    return downloaded_files or []
+    return buffers
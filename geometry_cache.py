@@ -0,0 +1,133 @@
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import radar_io
+
+class GeometryCache:
+    """
+    Caches the gate latitude/longitude arrays of a sweep.
+    They only depend on the radar site and the sweep layout (azimuths, elevation, gate spacing), so
+    consecutive scans from the same radar can share them. Each volume starts its sweeps at a different
+    azimuth and the ray centres jitter by a few thousandths of a degree, so rays are keyed by their slot on
+    the nominal azimuth grid (0.5 or 1 degree) rather than by their azimuth. The arrays are computed for the
+    slot centres in slot order and returned reordered into the scan's own ray order.
+    Arrays are held in memory (least recently used dropped past `max_entries`) and, when `directory` is
+    set, saved there as .npy files that later runs memory-map instead of recomputing.
+    """
+
+    def __init__(self, directory=None, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _layout(self, radar, sweep):
+        # (key, slot azimuths and elevation the geometry is computed for, order of the rays by slot)
+        sweep_slice = radar.get_slice(sweep)
+        site = radar.metadata.get('instrument_name', '')
+        if isinstance(site, bytes):
+            site = site.decode('ascii', 'ignore')
+
+        azimuths = np.asarray(radar.azimuth['data'][sweep_slice], dtype=np.float64)
+        slots, spacing = _azimuth_slots(azimuths)
+        order = np.argsort(slots, kind='stable')
+        elevation = round(float(radar.elevation['data'][sweep_slice].mean()), 1)
+
+        layout = hashlib.sha1()
+        layout.update(np.float32(spacing).tobytes())
+        layout.update(slots[order].astype(np.int32).tobytes())
+        layout.update(np.round(radar.range['data'], 1).astype(np.float32).tobytes())
+        layout.update(np.float32(elevation).tobytes())
+        layout.update(np.round([radar.latitude['data'][0], radar.longitude['data'][0]], 4).tobytes())
+        key = f"{site.strip() or 'radar'}_{layout.hexdigest()[:20]}"
+        return key, (slots[order] + 0.5) * spacing, elevation, order
+
+    def gate_lat_lon(self, radar, sweep):
+        """Returns (lats, lons) of every gate in the sweep, shaped (rays, gates), in the sweep's ray order."""
+        key, azimuths, elevation, order = self._layout(radar, sweep)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+        if entry is None:
+            path = os.path.join(self.directory, f"{key}.npy") if self.directory else None
+            if path and os.path.exists(path):
+                lat_lon = np.load(path, mmap_mode='r')
+                with self._lock:
+                    self.hits += 1
+            else:
+                lat_lon = _compute_lat_lon(radar, azimuths, elevation)
+                with self._lock:
+                    self.misses += 1
+                if path:
+                    fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=self.directory)
+                    with os.fdopen(fd, 'wb') as f:
+                        np.save(f, lat_lon)
+                    os.replace(tmp_path, path)
+
+            entry = (lat_lon[0], lat_lon[1])
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        # Cached rows are in slot order; a sweep that doesn't start at 0 degrees needs them moved back
+        if np.array_equal(order, np.arange(len(order))):
+            return entry
+        rows = np.empty_like(order)
+        rows[order] = np.arange(len(order))
+        return entry[0][rows], entry[1][rows]
+
+def _azimuth_slots(azimuths):
+    # Slot of each ray on the nominal grid, and the grid spacing: 0.5 degrees for super-resolution sweeps,
+    # 1 degree otherwise. Ray centres sit mid-slot, as far from the slot edges as jitter can get them.
+    steps = np.diff(np.sort(azimuths))
+    spacing = 0.5 if len(steps) and np.median(steps) < 0.75 else 1.0
+    slots = np.floor(np.mod(azimuths, 360.0) / spacing).astype(np.int64)
+    return slots, spacing
+
+def _compute_lat_lon(radar, azimuths, elevation):
+    pyart = radar_io.import_pyart()
+    x, y, _ = pyart.core.antenna_vectors_to_cartesian(radar.range['data'], azimuths, np.full(len(azimuths), elevation))
+    x /= 1000.0  # Convert to km
+    y /= 1000.0  # Convert to km
+
+    # Convert Cartesian x and y to latitudes and longitudes
+    lon_offset = x / (111.0 * np.cos(np.radians(radar.latitude['data'][0])))
+    lat_offset = y / 111.0
+    actual_lons = radar.longitude['data'][0] + lon_offset
+    actual_lats = radar.latitude['data'][0] + lat_offset
+
+    return np.stack([actual_lats, actual_lons]).astype(np.float32)
+
+# Shared by visualize.py and child_pr.py; call configure() to also keep the arrays on disk
+default_cache = GeometryCache()
+
+def configure(directory=None, max_entries=32):
+    global default_cache
+    default_cache = GeometryCache(directory, max_entries)
+    return default_cache
+
+def settings():
+    # Passed to render worker processes so they keep the arrays in the same directory
+    return default_cache.directory, default_cache.max_entries
+
+def configure_worker(worker_settings):
+    configure(*worker_settings)
+
+def gate_lat_lon(radar, sweep):
+    return default_cache.gate_lat_lon(radar, sweep)
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import zlib
+import cProfile
+import argparse
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak RSS is left out there
+    resource = None
+
+metrics_path = None
+profile_every = 0
+profile_directory = 'profiles'
+
+_fd = None
+_fd_pid = None
+_lock = threading.Lock()
+
+def configure(path, sample_every=0, profiles=profile_directory, truncate=True):
+    """
+    Turns on stage recording. Every stage() block then appends one JSON line to `path` with the stage
+    name, wall time, any bytes transferred, the process id and the process's peak RSS so far.
+    Render worker processes append to the same file. With `sample_every` set to N, roughly one event in N
+    is also run under cProfile and its stats saved to `profiles`/event-<id>.prof (see profile()).
+    """
+    global metrics_path, profile_every, profile_directory, _fd, _fd_pid
+
+    with _lock:
+        if _fd is not None and _fd_pid == os.getpid():
+            os.close(_fd)
+        metrics_path, profile_every, profile_directory = path, sample_every, profiles
+        _fd = _fd_pid = None
+        if path and truncate:
+            open(path, 'w').close()
+
+def settings():
+    # Passed to render worker processes so they record into the same file
+    return metrics_path, profile_every, profile_directory
+
+def configure_worker(worker_settings):
+    path, sample_every, profiles = worker_settings
+    configure(path, sample_every, profiles, truncate=False)
+
+def enabled():
+    return metrics_path is not None
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _write(record):
+    global _fd, _fd_pid
+
+    line = (json.dumps(record) + '\n').encode('utf-8')
+    with _lock:
+        if _fd is None or _fd_pid != os.getpid():
+            # Forked workers open their own descriptor; O_APPEND keeps lines from different processes whole
+            _fd = os.open(metrics_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            _fd_pid = os.getpid()
+        os.write(_fd, line)
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Times the block as one stage. `fields` (event_id, source, ...) are stored with the record, and the
+    block can add more to the yielded dict, e.g. record['bytes'] = n. Does nothing unless configured.
+    """
+    if metrics_path is None:
+        yield {}
+        return
+
+    record = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record.update(stage=name, seconds=time.perf_counter() - start, ts=time.time(), pid=os.getpid(), peak_rss_mb=peak_rss_mb())
+        _write(record)
+
+def sampled(event_id):
+    # Deterministic, so the same events are profiled whichever worker renders them
+    return profile_every > 0 and event_id is not None and zlib.crc32(str(event_id).encode()) % profile_every == 0
+
+@contextmanager
+def profile(event_id, source=None):
+    """
+    Runs the block under cProfile when this event is sampled, saving the stats to profile_directory as
+    event-<event id>[-<scan>].prof. Event ids are unique per row (see main.event_keys), and the scan name
+    keeps runs that picked different scans for the same event apart.
+    """
+    if metrics_path is None or not sampled(event_id):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(profile_directory, exist_ok=True)
+        scan = f"-{os.path.basename(source).split('.')[0]}" if source else ''
+        profiler.dump_stats(os.path.join(profile_directory, f"event-{event_id}{scan}.prof"))
+
+def read_records(path=None):
+    records = []
+    with open(path or metrics_path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+def summary(path=None):
+    """Aggregates the recorded stages into rows of count, total and mean time, p95, bytes and peak RSS."""
+    by_stage = {}
+    for record in read_records(path):
+        by_stage.setdefault(record['stage'], []).append(record)
+
+    rows = []
+    for name, records in by_stage.items():
+        seconds = sorted(r['seconds'] for r in records)
+        rss = [r['peak_rss_mb'] for r in records if r.get('peak_rss_mb') is not None]
+        rows.append({
+            'stage': name,
+            'count': len(records),
+            'total_s': sum(seconds),
+            'mean_ms': sum(seconds) / len(seconds) * 1000,
+            'p95_ms': seconds[min(int(len(seconds) * 0.95), len(seconds) - 1)] * 1000,
+            'mb': sum(r.get('bytes', 0) for r in records) / 1e6,
+            'errors': sum(1 for r in records if 'error' in r),
+            'peak_rss_mb': max(rss) if rss else None,
+        })
+    return sorted(rows, key=lambda row: row['total_s'], reverse=True)
+
+def print_summary(path=None):
+    rows = summary(path)
+    print(f"{'stage':<16} {'count':>7} {'total s':>9} {'mean ms':>9} {'p95 ms':>9} {'MB':>9} {'errors':>7} {'peak RSS MB':>12}")
+    for row in rows:
+        rss = f"{row['peak_rss_mb']:.0f}" if row['peak_rss_mb'] is not None else '-'
+        print(f"{row['stage']:<16} {row['count']:>7} {row['total_s']:>9.2f} {row['mean_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['mb']:>9.1f} {row['errors']:>7} {rss:>12}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize a metrics file written with main.py --metrics')
+    parser.add_argument('path', help='JSON lines metrics file')
+    args = parser.parse_args()
+
+    print_summary(args.path)
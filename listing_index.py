@@ -0,0 +1,180 @@
+import sqlite3
+import threading
+import time
+import calendar
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import download
+
+index_path = 'listing_index.sqlite'
+
+class ListingIndex:
+    """
+    On-disk index of the Level II keys under each `YYYY/MM/DD/RADAR` prefix.
+    Each scan is stored with its timestamp already parsed, so picking the scan for an event is a
+    binary search instead of a regex pass over the whole listing. Listings for past days never change
+    and are kept until they age out; listings for the last couple of days are re-fetched once they
+    are older than `recent_ttl` seconds because new scans may still be arriving.
+    """
+
+    def __init__(self, path=index_path, recent_ttl=15 * 60, max_age_days=90, max_listings=20000):
+        self.path = path
+        self.recent_ttl = recent_ttl
+        self.max_age_days = max_age_days
+        self.max_listings = max_listings
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._memory = {}  # (radar, day) -> (timestamps, keys)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS listings (
+                radar TEXT NOT NULL,
+                day TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (radar, day)
+            );
+            CREATE TABLE IF NOT EXISTS scans (
+                radar TEXT NOT NULL,
+                day TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (radar, day, key)
+            );
+            CREATE INDEX IF NOT EXISTS scans_by_time ON scans (radar, day, ts);
+            CREATE TABLE IF NOT EXISTS availability (
+                day TEXT PRIMARY KEY,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                radars TEXT NOT NULL
+            );
+        """)
+        self.evict()
+
+    def _is_stale(self, day, fetched_at):
+        # Data for the current UTC day (and the day before, to cover late uploads) can still grow
+        recent_cutoff = (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d')
+        return day >= recent_cutoff and time.time() - fetched_at > self.recent_ttl
+
+    def get_scans(self, radar_code, year, month, day):
+        """
+        Returns the cached (timestamps, keys) for a radar-day sorted by time, or None if the
+        listing isn't cached or is stale. An empty listing is cached too and returns ([], []).
+        """
+        day_key = f'{year}-{month:02}-{day:02}'
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT fetched_at FROM listings WHERE radar = ? AND day = ?', (radar_code, day_key)
+            ).fetchone()
+            if row is None or self._is_stale(day_key, row[0]):
+                self._memory.pop((radar_code, day_key), None)
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute(
+                'UPDATE listings SET last_used = ? WHERE radar = ? AND day = ?', (time.time(), radar_code, day_key)
+            )
+            self._conn.commit()
+
+            scans = self._memory.get((radar_code, day_key))
+            if scans is None:
+                rows = self._conn.execute(
+                    'SELECT ts, key FROM scans WHERE radar = ? AND day = ? ORDER BY ts, key', (radar_code, day_key)
+                ).fetchall()
+                scans = ([ts for ts, _ in rows], [key for _, key in rows])
+                self._memory[(radar_code, day_key)] = scans
+            return scans
+
+    def store(self, radar_code, year, month, day, keys):
+        """Parses and stores a fresh listing for a radar-day, returning it as (timestamps, keys)."""
+        day_key = f'{year}-{month:02}-{day:02}'
+
+        parsed = []
+        for key in keys:
+            if key.endswith('.tar'):  # Skip tar files
+                continue
+            try:
+                timestamp = download.extract_datetime_from_filename(key)
+            except ValueError:
+                continue
+            parsed.append((calendar.timegm(timestamp.timetuple()), key))
+        parsed.sort()
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute('DELETE FROM scans WHERE radar = ? AND day = ?', (radar_code, day_key))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO scans (radar, day, ts, key) VALUES (?, ?, ?, ?)',
+                [(radar_code, day_key, ts, key) for ts, key in parsed]
+            )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO listings (radar, day, fetched_at, last_used) VALUES (?, ?, ?, ?)',
+                (radar_code, day_key, now, now)
+            )
+            self._conn.commit()
+
+            scans = ([ts for ts, _ in parsed], [key for _, key in parsed])
+            self._memory[(radar_code, day_key)] = scans
+            return scans
+
+    def available_radars(self, year, month, day, s3=None):
+        """
+        Returns the set of radars with any data on a day. Taken from one delimited listing of the day's
+        prefix (download.list_radars) and cached like the scan listings, so picking among candidate radars
+        needs at most one S3 call per day instead of a list call per radar.
+        """
+        day_key = f'{year}-{month:02}-{day:02}'
+
+        with self._lock:
+            row = self._conn.execute('SELECT fetched_at, radars FROM availability WHERE day = ?', (day_key,)).fetchone()
+            if row is not None and not self._is_stale(day_key, row[0]):
+                self.hits += 1
+                self._conn.execute('UPDATE availability SET last_used = ? WHERE day = ?', (time.time(), day_key))
+                self._conn.commit()
+                return set(row[1].split())
+            self.misses += 1
+
+        radars = download.list_radars(download.bucket_name, year, month, day, s3)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO availability (day, fetched_at, last_used, radars) VALUES (?, ?, ?, ?)',
+                (day_key, now, now, ' '.join(sorted(radars)))
+            )
+            self._conn.commit()
+        return radars
+
+    def select_files(self, scans, start_time):
+        """Same selection as download.filter_files_based_on_time: the first scan at or after start_time."""
+        timestamps, keys = scans
+        idx = bisect_left(timestamps, calendar.timegm(start_time.timetuple()))
+        return [keys[idx]] if idx < len(keys) else []
+
+    def evict(self):
+        """Drops listings that haven't been used in `max_age_days`, then the least recently used beyond `max_listings`."""
+        cutoff = time.time() - self.max_age_days * 86400
+
+        with self._lock:
+            self._conn.execute('DELETE FROM listings WHERE last_used < ?', (cutoff,))
+            self._conn.execute('DELETE FROM availability WHERE last_used < ?', (cutoff,))
+            self._conn.execute("""
+                DELETE FROM listings WHERE rowid IN (
+                    SELECT rowid FROM listings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_listings,))
+            self._conn.execute("""
+                DELETE FROM scans WHERE NOT EXISTS (
+                    SELECT 1 FROM listings WHERE listings.radar = scans.radar AND listings.day = scans.day
+                )
+            """)
+            self._conn.commit()
+            self._memory.clear()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
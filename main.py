@@ -1,10 +1,25 @@
 import pandas as pd
 import cleanup
 import download
+import listing_index
+import archive_cache
+import geometry_cache
+import sweep_cache
+import s3_controller
 import visualize
+import shard_writer
+import scheduler
+import pipeline
+import manifest
+import instrumentation
+import products
+import radar_index
 import datetime
 import os
-import sys
+import random
+import zlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import gc  # Garbage Collector interface
 
@@ -15,76 +30,425 @@ def delete_file(file_path):
         if e.errno != 2:  # errno 2 is "No such file or directory"
             raise
 
-def process_batch(batch_df, debug=False):
-    downloaded_files_info = []
+def event_keys(enriched_df):
+    # Unique id of each row. `om` alone repeats: a tornado crossing state or county lines has one row per
+    # segment, so the state, county (f1) and segment number (sg) are added, e.g. "350981-GA145-2"
+    keys = enriched_df['om'].astype(str) + '-' + enriched_df['st'] + enriched_df['f1'].map('{:03}'.format) + '-' + enriched_df['sg'].astype(str)
+    repeat = keys.groupby(keys).cumcount()
+    return keys.where(repeat == 0, keys + '-' + repeat.astype(str))
+
+def select_events(enriched_df, random_sampling, start_idx, sample_size, seed):
+    # The same arguments always pick the same events, in the same order
+    if random_sampling:
+        return enriched_df.sample(sample_size, random_state=seed)
+    return enriched_df.iloc[start_idx:start_idx + sample_size]
+
+def shard_of(radar_code, year, month, day, shard_count):
+    return zlib.crc32(f"{radar_code}/{year:04}/{month:02}/{day:02}".encode()) % shard_count
+
+def shard_events(enriched_df, shard_index, shard_count):
+    """
+    Keeps the events of shard `shard_index` (0 based) out of `shard_count`. Events are assigned by a hash of
+    their radar and date, so the shards of a sample are disjoint, together cover it, and every radar-day
+    is listed and downloaded by a single node.
+    """
+    shards = [
+        shard_of(radar_code, year, month, day, shard_count)
+        for radar_code, year, month, day in zip(enriched_df['Nearest Radar Station'], enriched_df['yr'], enriched_df['mo'], enriched_df['dy'])
+    ]
+    return enriched_df[[shard == shard_index for shard in shards]]
+
+def choose_available_radars(enriched_df, index, workers=1):
+    """
+    Moves each event to the nearest of its candidate radars that has data on the event's date, so a radar
+    that was down doesn't cost the event. Availability comes from the listing index: one cached, delimited
+    list call per day covers every radar. Events where no candidate has data keep their nearest radar.
+    """
+    if 'Candidate Radars' in enriched_df:
+        candidates = [radar_index.parse_candidates(value) for value in enriched_df['Candidate Radars']]
+    else:
+        # Built by an older cleanup; look the candidates up here instead
+        candidates = radar_index.default_index().candidates(enriched_df['slat'].to_numpy(), enriched_df['slon'].to_numpy())
 
-    for _, row in tqdm(batch_df.iterrows(), desc="Downloading data", total=batch_df.shape[0]):
+    days = list(zip(enriched_df['yr'], enriched_df['mo'], enriched_df['dy']))
+    s3 = download.get_s3_client(max_pool_connections=max(workers, 10))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        unique_days = sorted(set(days))
+        available = dict(zip(unique_days, executor.map(lambda day: index.available_radars(*day, s3), unique_days)))
+
+    chosen = []
+    for event_candidates, day in zip(candidates, days):
+        with_data = [code for code, _ in event_candidates if code in available[day]]
+        chosen.append(with_data[0] if with_data else event_candidates[0][0])
+
+    enriched_df = enriched_df.copy()
+    moved = (enriched_df['Nearest Radar Station'].to_numpy() != chosen).sum()
+    enriched_df['Nearest Radar Station'] = chosen
+    missing = sum(1 for code, day in zip(chosen, days) if code not in available[day])
+    print(f"Radar selection: {moved} events switched radar, {missing} have no candidate radar with data")
+    return enriched_df
+
+def batch_events(batch_df):
+    # Download requests as (year, month, day, radar_code, start_time) and the matching event details
+    events = []
+    rows = []
+
+    for _, row in batch_df.iterrows():
         year, month, day = row['yr'], row['mo'], row['dy']
         hour, minute, seconds = map(int, row['time'].split(':'))
         radar_code = row['Nearest Radar Station']
         
         start_time = datetime.datetime(year, month, day, hour, minute, seconds)
 
-        try:
-            downloaded_files = download.main_download_proccess(year, month, day, radar_code, start_time, download.compressed_dir, download.uncompressed_dir)
-            downloaded_files_info.extend([(file_path, radar_code, year, month, day, hour, minute, seconds, row['slat'], row['slon']) for file_path in downloaded_files])
-        except Exception as e:
-            print(f"Error downloading data for {radar_code} on {year}-{month:02}-{day:02}. Error: {e}")
+        # Resumed events carry the scan their first run picked, which is downloaded without listing again
+        scan_key = row.get('scan_key')
+        events.append((year, month, day, radar_code, start_time, scan_key if isinstance(scan_key, str) else None))
+        rows.append((row['event_id'], radar_code, year, month, day, hour, minute, seconds, row['slat'], row['slon']))
+
+    return events, rows
+
+def record_download(event_info, downloaded_files, error, job=None):
+    event_id, radar_code, year, month, day = event_info[:5]
+    if error is not None:
+        print(f"Error downloading data for {radar_code} on {year}-{month:02}-{day:02}. Error: {error}")
+        if job is not None:
+            job.update(event_id, manifest.FAILED, reason=f"download: {error}")
+        return
+    if job is not None:
+        if downloaded_files:
+            job.update(event_id, manifest.DOWNLOADED)
+        else:
+            job.update(event_id, manifest.FAILED, reason="download: no scan found")
+
+def record_render(event_info, key, error, sample, writer=None, job=None):
+    # `sample` is a sample dict, a list of them with samples_per_scan above 1, or None for saved PNGs
+    event_id, radar_code, year, month, day, hour, minute, seconds, slat, slon = event_info
+    if error is not None:
+        print(f"Error visualizing data for {radar_code} on {year}-{month:02}-{day:02}. Error: {error}")
+        if job is not None:
+            job.update(event_id, manifest.FAILED, reason=f"render: {error}")
+    elif sample is not None:
+        # Marked rendered by the writer's callback once its shard is on disk
+        for each in sample if isinstance(sample, list) else [sample]:
+            writer.append(each['image'], each['channels'] if 'channels' in each else each['velocity'], {
+                'event_id': event_id,
+                'radar_code': radar_code,
+                'scan_time': download.extract_datetime_from_filename(key).isoformat(),
+                'event_time': datetime.datetime(year, month, day, hour, minute, seconds).isoformat(),
+                'tornado_lat': slat,
+                'tornado_lon': slon,
+                'lat_offset': each['lat_offset'],
+                'lon_offset': each['lon_offset'],
+                'rotation': each['rotation'],
+                'source_key': key,
+            })
+    elif job is not None:
+        job.update(event_id, manifest.RENDERED)
+
+def render_options(debug, engine, writer, event_id, samples_per_scan=1, rotate=False, product_spec=None):
+    # With a shard writer the samples come back as arrays instead of being saved as PNGs
+    return {'debug_mode': debug, 'engine': engine, 'return_sample': writer is not None, 'event_id': event_id, 'samples_per_scan': samples_per_scan, 'rotate': rotate, 'products': product_spec}
+
+def process_batch(batch_df, debug=False, download_workers=1, render_workers=1, index=None, stream=False, cache=None, engine='matplotlib', writer=None, job=None, samples_per_scan=1, rotate=False, product_spec=None, last_sweep=None):
+    # `job` is the manifest.JobManifest recording each event's progress, if any
+    downloaded_files_info = []
+    events, rows = batch_events(batch_df)
+
+    def on_selected(position, key):
+        if job is not None:
+            job.update(rows[position][0], manifest.LISTED, scan_key=key)
+
+    # Download the batch over one pooled S3 client, listing each radar-day and fetching each scan only once
+    with tqdm(desc="Downloading data", total=len(events)) as progress, instrumentation.stage('batch_download', events=len(events)):
+        results, stats = scheduler.schedule_downloads(events, download_workers, download.compressed_dir, download.uncompressed_dir, index=index, stream=stream, cache=cache, on_complete=progress.update, on_selected=on_selected, last_sweep=last_sweep)
+    print(f"{stats['events']} events over {stats['radar_days']} radar-days, {stats['distinct_scans']} distinct scans "
+          f"({stats['list_calls_saved']} list calls and {stats['downloads_saved']} downloads saved by sharing)")
+
+    for event_info, (downloaded_files, error) in zip(rows, results):
+        record_download(event_info, downloaded_files, error, job)
+        downloaded_files_info.extend([(file_path, key, *event_info) for key, file_path in downloaded_files])
 
     # After all files in the batch are downloaded, we visualize them
     print("\n")
-    for file_info in tqdm(downloaded_files_info, desc="Visualizing data", total=len(downloaded_files_info)):
-        file_path, radar_code, year, month, day, hour, minute, seconds, slat, slon = file_info
-        try:
-            visualize.visualize_radar_data(file_path, visualize.image_directory, slat, slon, debug)
+    if writer is None:
+        os.makedirs(visualize.image_directory, exist_ok=True)
+    tasks = [
+        (file_path, visualize.image_directory, slat, slon, render_options(debug, engine, writer, event_id, samples_per_scan, rotate, product_spec))
+        for file_path, _, event_id, *_, slat, slon in downloaded_files_info
+    ]
+    with tqdm(desc="Visualizing data", total=len(tasks)) as progress, instrumentation.stage('batch_render', events=len(tasks)):
+        render_results = visualize.visualize_files(tasks, render_workers, on_complete=progress.update)
+
+    for file_info, (_, error, sample) in zip(downloaded_files_info, render_results):
+        file_path, key, *event_info = file_info
+        record_render(event_info, key, error, sample, writer, job)
+        if isinstance(file_path, str):  # Streamed scans are in-memory buffers with nothing to delete
             delete_file(file_path)
-        except Exception as e:
-            print(f"Error visualizing data for {radar_code} on {year}-{month:02}-{day:02}. Error: {e}")
 
     # Clear the list to free up memory
     downloaded_files_info.clear()
     gc.collect()  # Run garbage collector to free up unreferenced memory
 
-def main_process(debug=False, debug_idx=None, batch_size=100):
+def process_pipelined(events_df, debug=False, download_workers=1, render_workers=1, max_in_flight=8, disk_budget_bytes=None, index=None, stream=False, cache=None, engine='matplotlib', writer=None, job=None, samples_per_scan=1, rotate=False, product_spec=None, last_sweep=None):
+    # Like process_batch for the whole sample at once, but rendering starts as soon as the first scan arrives
+    # and only a bounded number of scans (see pipeline.run_pipeline) are ever held at a time
+    events, rows = batch_events(events_df)
+    if writer is None:
+        os.makedirs(visualize.image_directory, exist_ok=True)
+    render_args = [(slat, slon, render_options(debug, engine, writer, event_id, samples_per_scan, rotate, product_spec)) for event_id, *_, slat, slon in rows]
+
+    def on_selected(position, key):
+        if job is not None:
+            job.update(rows[position][0], manifest.LISTED, scan_key=key)
+
+    with tqdm(desc="Processing events", total=len(events)) as progress, instrumentation.stage('pipeline', events=len(events)):
+        def on_downloaded(position, downloaded_files, error):
+            record_download(rows[position], downloaded_files, error, job)
+            if not downloaded_files:
+                progress.update()
+
+        def on_rendered(position, key, error, sample):
+            record_render(rows[position], key, error, sample, writer, job)
+            progress.update()
+
+        budget = pipeline.DiskBudget(disk_budget_bytes)
+        stats = pipeline.run_pipeline(
+            events, render_args, download_workers, render_workers, max_in_flight, budget, index=index, stream=stream, cache=cache,
+            on_selected=on_selected, on_downloaded=on_downloaded, on_rendered=on_rendered, last_sweep=last_sweep,
+        )
+    print(f"{stats['events']} events, {stats['distinct_scans']} distinct scans, at most {stats['peak_bytes'] / 1e6:.0f} MB of volumes held at once")
+
+def main_process(debug=False, debug_idx=None, batch_size=100, download_workers=1, render_workers=1, use_listing_index=True, stream=False, cache_directory=None, cache_max_bytes=20 * 1024**3, engine='matplotlib', output='png', shard_size=4096, seed=None, resume=False, retry_failed=False, manifest_path=manifest.manifest_path, sample_size=None, random_sampling=True, start_idx=0, shard=None, pipelined=False, max_in_flight=8, disk_budget_bytes=None, samples_per_scan=1, rotate=False, product_spec=None, partial_fetch=False):
+    # Without a sample_size the sampling is asked for interactively. `shard` is an (index, count) pair
+    # selecting this node's part of the sample, see shard_events. With `pipelined` set, downloads and renders
+    # overlap instead of alternating batch by batch (see process_pipelined).
+    # samples_per_scan, rotate and product_spec (a list of (field, sweep) pairs) are passed to visualize_radar_data.
+    # With partial_fetch set, volumes are only downloaded up to the highest sweep the products use.
+
     # 1. Cleanup and Prepare enriched_tornado_data.csv
     cleanup.cleanup_tornado_data()
 
     # 2. Load enriched tornado data
     enriched_df = pd.read_csv('enriched_tornado_data.csv')
+    enriched_df['event_id'] = event_keys(enriched_df)
+
+    # Progress of every selected event is recorded so an interrupted run can be resumed
+    job = None if debug else manifest.JobManifest(manifest_path)
+
+    # Cached S3 listings, shared across batches and runs
+    index = listing_index.ListingIndex() if use_listing_index else None
 
     # 3. Ask the user how they want the sampling to be
     if debug:
         enriched_df = enriched_df.iloc[[debug_idx]]
+    elif resume:
+        if job.settings() is None:
+            print(f"No job to resume in {manifest_path}.")
+            return
+        if job.settings().get('event_key') != manifest.event_key:
+            print(f"The job in {manifest_path} was started by an older version that keyed events by om alone, so it can't be resumed.")
+            return
+        # Keep only the unfinished events, in their original order
+        unfinished = {event_id: position for position, event_id in enumerate(job.unfinished(retry_failed))}
+        order = enriched_df['event_id'].map(unfinished)
+        enriched_df = enriched_df[order.notna()].iloc[order.dropna().argsort()].copy()
+
+        # Use the radar and scan the first run assigned instead of choosing them again, which could differ
+        # (e.g. without the listing index, or once the listings change) and mix scans from two radars
+        assignments = job.assignments()
+        recorded = enriched_df['event_id'].map(lambda event_id: assignments.get(event_id, (None, None)))
+        # Keys are <year>/<month>/<day>/<radar>/<file>, which also recovers the radar of older manifests
+        radars = recorded.map(lambda assigned: assigned[0] or (assigned[1].split('/')[3] if assigned[1] else None))
+        enriched_df['Nearest Radar Station'] = radars.where(radars.notna(), enriched_df['Nearest Radar Station'])
+        enriched_df['scan_key'] = recorded.map(lambda assigned: assigned[1])
+        print(f"Resuming job: {len(enriched_df)} unfinished events ({job.counts()})")
+    else:
+        if sample_size is None:
+            sampling_choice = input("Do you want the sampling to be random? (y/n): ").strip().lower()
+            random_sampling = sampling_choice == 'y'
+
+            start_idx = 0
+            if sampling_choice == 'n':
+                start_idx = int(input(f"Please enter the starting index (between 0 and {len(enriched_df)-1}): "))
+
+            sample_size = int(input("How many samples would you like to produce? "))
+        elif shard is not None and random_sampling and seed is None:
+            print("Sharded random sampling needs a seed, so that every node draws the same sample.")
+            return
+
+        # The seed is saved in the manifest so the same sample can be drawn again
+        seed = seed if seed is not None else random.randrange(2**32)
+        enriched_df = select_events(enriched_df, random_sampling, start_idx, sample_size, seed)
+
+        # Fall back to the next nearest radar when the nearest one has no data that day. This comes before
+        # sharding, so the sample is split by the radar each event will actually be downloaded from
+        if index is not None:
+            enriched_df = choose_available_radars(enriched_df, index, download_workers)
+
+        # Every node draws the same sample and keeps only its own radar-days
+        if shard is not None:
+            enriched_df = shard_events(enriched_df, *shard)
+            print(f"Shard {shard[0]}/{shard[1]}: {len(enriched_df)} of {sample_size} events")
+
+        job.start({'random': random_sampling, 'start_idx': start_idx, 'sample_size': sample_size, 'seed': seed, 'shard': list(shard) if shard else None, 'event_key': manifest.event_key}, enriched_df['event_id'], enriched_df['Nearest Radar Station'])
+
+    # Debug runs choose radars here, as do resumed events whose radar wasn't recorded (jobs from older versions)
+    if index is not None and debug:
+        enriched_df = choose_available_radars(enriched_df, index, download_workers)
+    elif index is not None and resume and radars.isna().any():
+        chosen = choose_available_radars(enriched_df[radars.isna()], index, download_workers)
+        enriched_df.loc[chosen.index, 'Nearest Radar Station'] = chosen['Nearest Radar Station']
+
+    # Local copies of raw volumes, so regenerating a dataset doesn't download them again
+    cache = archive_cache.ArchiveCache(cache_directory, cache_max_bytes) if cache_directory else None
+
+    # Samples go either to PNGs in radar_images/ or to .npy shards in radar_shards/
+    def on_shard_written(shard_rows):
+        if job is not None:
+            for shard_row in shard_rows:
+                job.update(shard_row['event_id'], manifest.RENDERED)
+
+    # Each node names its shards after its part, so shard directories from many nodes can be merged
+    prefix = f"shard-{shard[0]:03}-of-{shard[1]:03}" if shard else 'shard'
+    channels = None
+    if product_spec and product_spec != products.default_products:
+        channels = [(name, *products.field_scales[field][1:]) for name, (field, _) in zip(products.channel_names(product_spec), product_spec)]
+    writer = shard_writer.ShardWriter(shard_size=shard_size, prefix=prefix, on_shard_written=on_shard_written, channels=channels) if output == 'shards' else None
+    last_sweep = max(sweep for _, sweep in product_spec or products.default_products) if partial_fetch else None
+
+    # 4. Process the data in batches to avoid memory issues, or stream it through a bounded pipeline
+    if pipelined:
+        process_pipelined(
+            enriched_df, debug, download_workers=download_workers, render_workers=render_workers, max_in_flight=max_in_flight,
+            disk_budget_bytes=disk_budget_bytes, index=index, stream=stream, cache=cache, engine=engine, writer=writer, job=job,
+            samples_per_scan=samples_per_scan, rotate=rotate, product_spec=product_spec, last_sweep=last_sweep
+        )
     else:
-        sampling_choice = input("Do you want the sampling to be random? (y/n): ").strip().lower()
+        for start_idx in range(0, len(enriched_df), batch_size):
+            end_idx = min(start_idx + batch_size, len(enriched_df))
+            batch_df = enriched_df.iloc[start_idx:end_idx]
 
-        if sampling_choice == 'n':
-            start_idx = int(input(f"Please enter the starting index (between 0 and {len(enriched_df)-1}): "))
-            enriched_df = enriched_df.iloc[start_idx:]
+            print(f"\nProcessing batch {start_idx // batch_size + 1}/{(len(enriched_df) - 1) // batch_size + 1}")
+            process_batch(
+                batch_df, debug, download_workers=download_workers, render_workers=render_workers,
+                index=index, stream=stream, cache=cache, engine=engine, writer=writer, job=job,
+                samples_per_scan=samples_per_scan, rotate=rotate, product_spec=product_spec, last_sweep=last_sweep
+            )
 
-        sample_size = int(input("How many samples would you like to produce? "))
-        enriched_df = enriched_df.sample(sample_size) if sampling_choice == 'y' else enriched_df.iloc[:sample_size]
+            # Clear memory
+            del batch_df
+            gc.collect()
 
-    # 4. Process the data in batches to avoid memory issues
-    for start_idx in range(0, len(enriched_df), batch_size):
-        end_idx = min(start_idx + batch_size, len(enriched_df))
-        batch_df = enriched_df.iloc[start_idx:end_idx]
+    if writer is not None:
+        writer.close()
+        print(f"Wrote {writer.samples_written} samples to {writer.directory}/")
+    if index is not None:
+        index.close()
+    if job is not None:
+        print(f"Job progress: {job.counts()}")
+        job.close()
+    if cache is not None:
+        print(f"Archive cache: {cache.stats()}")
+    print(f"S3 requests: {s3_controller.stats()}")
+    if instrumentation.enabled():
+        print(f"\nStage timings (details in {instrumentation.metrics_path}):")
+        instrumentation.print_summary()
 
-        print(f"\nProcessing batch {start_idx // batch_size + 1}/{(len(enriched_df) - 1) // batch_size + 1}")
-        process_batch(batch_df, debug)
+def _shard_arg(value):
+    # "i/N": part i (0 based) of N
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}")
+    return index, count
 
-        # Clear memory
-        del batch_df
-        gc.collect()
+def _products_arg(value):
+    try:
+        return products.parse_products(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 # Call the main process function
 if __name__ == "__main__":
-    if '--debug' in sys.argv:
-        try:
-            idx = int(sys.argv[sys.argv.index('--debug') + 1])
-            idx -= 2  # Adjust for the first 4 lines in enriched_tornado_data.csv
-            main_process(debug=True, debug_idx=idx)
-        except (IndexError, ValueError):
-            print("Please specify the index for debug mode. Usage: --debug [index]")
+    parser = argparse.ArgumentParser(description='Download and visualize NEXRAD velocity data for tornado events')
+    parser.add_argument('--debug', type=int, metavar='INDEX', help='Process a single row of enriched_tornado_data.csv')
+    parser.add_argument('--workers', type=int, default=1, help='Number of concurrent downloads (default: 1)')
+    parser.add_argument('--s3-max-concurrency', type=int, default=64, help='Upper bound of the adaptive limit on S3 requests in flight (default: 64)')
+    parser.add_argument('--no-listing-index', action='store_true', help='Always list S3 instead of using the cached listing index')
+    parser.add_argument('--stream', action='store_true', help='Download and decompress scans in memory instead of through temp files')
+    parser.add_argument('--archive-cache', metavar='DIR', help='Keep downloaded Level II volumes in DIR and reuse them on later runs')
+    parser.add_argument('--archive-cache-gb', type=float, default=20, help='Size limit of the archive cache in GB (default: 20)')
+    parser.add_argument('--render-workers', type=int, default=1, help='Number of processes used to render images (default: 1)')
+    parser.add_argument('--pipeline', action='store_true', help='Overlap downloading and rendering instead of alternating batch by batch')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='With --pipeline, scans downloading or waiting to render at once (default: 8)')
+    parser.add_argument('--disk-budget-gb', type=float, default=4, help='With --pipeline, size limit of the downloaded scans held at once in GB (default: 4)')
+    parser.add_argument('--output', choices=['png', 'shards'], default='png', help='Write PNGs to radar_images/ or .npy shards to radar_shards/ (default: png)')
+    parser.add_argument('--shard-size', type=int, default=4096, help='Samples per shard with --output shards (default: 4096)')
+    parser.add_argument('--samples-per-scan', type=int, default=1, metavar='K', help='Cut K samples with independent offsets from each decoded scan (default: 1)')
+    parser.add_argument('--rotate', action='store_true', help='Give each sample a random rotation (uses the numpy engine)')
+    parser.add_argument('--products', type=_products_arg, metavar='SPEC', help='Comma separated field:sweep pairs to render as channels of each sample, e.g. velocity:3,reflectivity:0 (default: velocity:3)')
+    parser.add_argument('--partial-fetch', action='store_true', help='Download each volume only up to the highest sweep rendered, with ranged GETs')
+    parser.add_argument('--sample-size', type=int, help='Number of events to sample; skips the interactive prompts')
+    parser.add_argument('--sequential', action='store_true', help='With --sample-size, take consecutive rows from --start instead of a random sample')
+    parser.add_argument('--start', type=int, default=0, help='First row for --sequential (default: 0)')
+    parser.add_argument('--shard', type=_shard_arg, metavar='i/N', help='Process only part i (0 based) of N of the sample, split by radar and date')
+    parser.add_argument('--seed', type=int, help='Random seed for sampling (default: a new one, saved in the job manifest)')
+    parser.add_argument('--resume', action='store_true', help='Continue the job in the manifest, skipping events that already finished')
+    parser.add_argument('--retry-failed', action='store_true', help='With --resume, also retry events that failed')
+    parser.add_argument('--manifest', default=manifest.manifest_path, help=f'Job manifest file (default: {manifest.manifest_path})')
+    parser.add_argument('--geometry-cache', metavar='DIR', help='Save gate geometry arrays in DIR so later runs can memory-map them')
+    parser.add_argument('--sweep-cache', metavar='DIR', help='Save every decoded sweep in DIR so later renders of the same scan skip decoding')
+    parser.add_argument('--sweep-cache-gb', type=float, default=10, help='Size limit of the sweep cache in GB (default: 10)')
+    parser.add_argument('--metrics', metavar='FILE', help='Record per-stage timings, bytes and peak memory to FILE as JSON lines')
+    parser.add_argument('--profile-every', type=int, default=0, metavar='N', help='With --metrics, run about one event in N under cProfile (saved to profiles/)')
+    parser.add_argument('--engine', choices=['matplotlib', 'numpy'], default='matplotlib', help='Image renderer (default: matplotlib)')
+
+    args = parser.parse_args()
+
+    if args.geometry_cache:
+        geometry_cache.configure(args.geometry_cache)
+    s3_controller.configure(initial_limit=min(8, args.s3_max_concurrency), max_limit=args.s3_max_concurrency)
+    if args.sweep_cache:
+        sweep_cache.configure(args.sweep_cache, int(args.sweep_cache_gb * 1024**3))
+    if args.metrics:
+        instrumentation.configure(args.metrics, args.profile_every)
+
+    options = dict(
+        download_workers=args.workers,
+        render_workers=args.render_workers,
+        use_listing_index=not args.no_listing_index,
+        stream=args.stream,
+        cache_directory=args.archive_cache,
+        cache_max_bytes=int(args.archive_cache_gb * 1024**3),
+        engine=args.engine,
+        output=args.output,
+        shard_size=args.shard_size,
+        seed=args.seed,
+        resume=args.resume,
+        retry_failed=args.retry_failed,
+        manifest_path=args.manifest,
+        sample_size=args.sample_size,
+        random_sampling=not args.sequential,
+        start_idx=args.start,
+        shard=args.shard,
+        pipelined=args.pipeline,
+        max_in_flight=args.max_in_flight,
+        disk_budget_bytes=int(args.disk_budget_gb * 1024**3),
+        samples_per_scan=args.samples_per_scan,
+        rotate=args.rotate,
+        product_spec=args.products,
+        partial_fetch=args.partial_fetch,
+    )
+
+    # Nodes sharing a file system keep separate manifests unless one is given explicitly
+    if args.shard and args.manifest == manifest.manifest_path:
+        base, ext = os.path.splitext(manifest.manifest_path)
+        options['manifest_path'] = f"{base}-{args.shard[0]:03}-of-{args.shard[1]:03}{ext}"
+
+    if args.debug is not None:
+        idx = args.debug - 2  # Adjust for the first 4 lines in enriched_tornado_data.csv
+        main_process(debug=True, debug_idx=idx, **options)
     else:
-        main_process()
\ No newline at end of file
+        main_process(**options)
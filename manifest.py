@@ -0,0 +1,88 @@
+import json
+import sqlite3
+import time
+
+manifest_path = 'job_manifest.sqlite'
+
+# Event states, in the order an event moves through them
+PENDING, LISTED, DOWNLOADED, RENDERED, FAILED = 'pending', 'listed', 'downloaded', 'rendered', 'failed'
+
+# How event ids are made (see main.event_keys), saved with the settings so older manifests aren't misread
+event_key = 'om-state-county-segment'
+
+class JobManifest:
+    """
+    Persistent record of a dataset build: the sampling settings (including the random seed) and the
+    state of every selected event, keyed by its event id (`om` plus the state, county and segment, since a
+    tornado crossing state lines has several rows with the same `om`). Each event also keeps the radar it was
+    assigned and, once listed, the scan picked for it, so a resumed job uses the same ones (see assignments()).
+    Every update is committed straight away, so after a crash the manifest still says which events already
+    produced output and `--resume` only has to process the rest.
+    """
+
+    def __init__(self, path=manifest_path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                event_id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                radar_code TEXT,
+                scan_key TEXT,
+                reason TEXT,
+                updated_at REAL NOT NULL
+            );
+        """)
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(events)')]
+        if 'radar_code' not in columns:  # Written before radars were recorded
+            self._conn.execute('ALTER TABLE events ADD COLUMN radar_code TEXT')
+        self._conn.commit()
+
+    def start(self, settings, event_ids, radar_codes=None):
+        """Starts a new job, replacing whatever this manifest held before. `radar_codes` matches `event_ids`."""
+        now = time.time()
+        with self._conn:
+            self._conn.execute('DELETE FROM meta')
+            self._conn.execute('DELETE FROM events')
+            self._conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)', ('settings', json.dumps(settings)))
+            radar_codes = [None] * len(event_ids) if radar_codes is None else list(radar_codes)
+            self._conn.executemany(
+                'INSERT INTO events (event_id, position, state, radar_code, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [(str(event_id), position, PENDING, radar_code, now) for position, (event_id, radar_code) in enumerate(zip(event_ids, radar_codes))]
+            )
+
+    def settings(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def unfinished(self, retry_failed=False):
+        """Event ids that still need work, in their original order."""
+        states = (PENDING, LISTED, DOWNLOADED, FAILED) if retry_failed else (PENDING, LISTED, DOWNLOADED)
+        placeholders = ', '.join('?' for _ in states)
+        rows = self._conn.execute(
+            f'SELECT event_id FROM events WHERE state IN ({placeholders}) ORDER BY position', states
+        ).fetchall()
+        return [event_id for event_id, in rows]
+
+    def assignments(self):
+        """{event id: (radar code, scan key)} as recorded so far; either is None if it wasn't recorded."""
+        return {event_id: (radar_code, scan_key) for event_id, radar_code, scan_key in self._conn.execute('SELECT event_id, radar_code, scan_key FROM events')}
+
+    def update(self, event_id, state, scan_key=None, reason=None):
+        with self._conn:
+            self._conn.execute(
+                'UPDATE events SET state = ?, scan_key = COALESCE(?, scan_key), reason = ?, updated_at = ? WHERE event_id = ?',
+                (state, scan_key, reason, time.time(), str(event_id))
+            )
+
+    def counts(self):
+        return dict(self._conn.execute('SELECT state, COUNT(*) FROM events GROUP BY state').fetchall())
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,205 @@
+import io
+import json
+import time
+import threading
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import download
+import radar_io
+import child_pr
+import s3_controller
+
+class NowcastService:
+    """
+    Keeps everything child_pr.main() sets up per call warm across requests: the radar KDTree, one pooled
+    S3 client, the latest scan per radar and the rendered images. A radar's latest scan is re-checked at
+    most every `poll_interval` seconds, and only keys after the one already known are listed. Images are
+    cached per (radar, scan, lat/lon rounded to `precision` decimals), so repeated lookups near the same
+    radar within one scan interval are served without touching S3 or pyart.
+    """
+
+    def __init__(self, poll_interval=60, precision=2, max_images=256, max_volumes=8):
+        self.poll_interval = poll_interval
+        self.precision = precision
+        self.max_images = max_images
+        self.max_volumes = max_volumes
+        self.s3 = download.get_s3_client()
+
+        # Pay for the radar table and pyart once at startup instead of on the first request
+        child_pr.radar_sites()
+        radar_io.import_pyart()
+
+        self._latest = {}  # radar -> (prefix, key, checked_at)
+        self._volumes = OrderedDict()  # scan key -> decompressed bytes
+        self._images = OrderedDict()  # (radar, key, lat, lon) -> (velocity, reflectivity)
+        self._lock = threading.Lock()
+        self._radar_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _radar_lock(self, radar_site):
+        with self._lock:
+            return self._radar_locks.setdefault(radar_site, threading.Lock())
+
+    def latest_scan(self, radar_site):
+        """Returns the key of the newest scan for a radar, listing S3 only once the cached one is stale."""
+        now = datetime.utcnow()
+        cached = self._latest.get(radar_site)
+        if cached and time.time() - cached[2] < self.poll_interval:
+            if cached[1] is None:
+                raise LookupError(f"No recent scans found for {radar_site}.")
+            return cached[1]
+
+        prefix = f'{now.year}/{now.month:02}/{now.day:02}/{radar_site}'
+        start_after = cached[1] if cached and cached[0] == prefix else None
+        files = [f for f in child_pr.list_files(child_pr.bucket_name, prefix, self.s3, start_after) if not f.endswith('_MDM')]
+
+        if files:
+            key = files[-1]
+        elif start_after:
+            key = start_after
+        else:
+            # Nothing yet today (just after midnight UTC), use the end of yesterday
+            yesterday = now - timedelta(days=1)
+            prefix = f'{yesterday.year}/{yesterday.month:02}/{yesterday.day:02}/{radar_site}'
+            files = [f for f in child_pr.list_files(child_pr.bucket_name, prefix, self.s3) if not f.endswith('_MDM')]
+            if not files:
+                # Remembered for a poll interval, so a radar that is down isn't listed on every request
+                self._latest[radar_site] = (None, None, time.time())
+                raise LookupError(f"No recent scans found for {radar_site}.")
+            key = files[-1]
+
+        self._latest[radar_site] = (prefix, key, time.time())
+        return key
+
+    def _volume(self, key):
+        with self._lock:
+            if key in self._volumes:
+                self._volumes.move_to_end(key)
+                return self._volumes[key]
+
+        decompressed_data = child_pr.download_and_decompress(key, self.s3)
+        if decompressed_data is None:
+            raise IOError(f"Failed to download {key}.")
+        data = decompressed_data.getvalue()
+
+        with self._lock:
+            self._volumes[key] = data
+            while len(self._volumes) > self.max_volumes:
+                self._volumes.popitem(last=False)
+        return data
+
+    def nowcast(self, lat, lon):
+        """Returns a dict with the radar, scan key and base64 velocity and reflectivity images for a location."""
+        lat, lon = round(lat, self.precision), round(lon, self.precision)
+
+        # Use the nearest radar that has recent scans
+        for radar_site in child_pr.nearby_radar_sites(lat, lon):
+            try:
+                with self._radar_lock(radar_site):
+                    key = self.latest_scan(radar_site)
+                break
+            except LookupError as e:
+                error = e
+        else:
+            raise error
+
+        # One request per radar does the listing and rendering, the rest wait and then hit the cache
+        with self._radar_lock(radar_site):
+            image_key = (radar_site, key, lat, lon)
+
+            with self._lock:
+                images = self._images.get(image_key)
+                if images:
+                    self._images.move_to_end(image_key)
+                    self.hits += 1
+
+            if not images:
+                data = self._volume(key)
+                images = child_pr.render_images(io.BytesIO(data), lat, lon)
+                with self._lock:
+                    self.misses += 1
+                    self._images[image_key] = images
+                    while len(self._images) > self.max_images:
+                        self._images.popitem(last=False)
+
+        return {
+            'radar': radar_site,
+            'scan': key,
+            'velocity': images[0],
+            'reflectivity': images[1],
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'radars': len(self._latest),
+                'cached_images': len(self._images),
+                'cached_volumes': len(self._volumes),
+                'hits': self.hits,
+                'misses': self.misses,
+                's3': s3_controller.stats(),
+            }
+
+class NowcastHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == '/health':
+            self._send_json(200, self.service.stats())
+            return
+
+        if url.path != '/nowcast':
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        query = parse_qs(url.query)
+        try:
+            lat = float(query['lat'][0])
+            lon = float(query['lon'][0])
+        except (KeyError, ValueError):
+            self._send_json(400, {'error': 'lat and lon are required numbers'})
+            return
+
+        try:
+            self._send_json(200, self.service.nowcast(lat, lon))
+        except LookupError as e:
+            self._send_json(404, {'error': str(e)})
+        except Exception as e:
+            print(f"Failed to build nowcast for {lat}, {lon}. Error: {e}")
+            self._send_json(500, {'error': str(e)})
+
+def serve(host='127.0.0.1', port=8080, poll_interval=60):
+    NowcastHandler.service = NowcastService(poll_interval=poll_interval)
+    server = ThreadingHTTPServer((host, port), NowcastHandler)
+    print(f"Serving nowcasts on http://{host}:{port}/nowcast?lat=..&lon=..")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve child_pr nowcasts over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--poll-interval', type=int, default=60, help='Seconds before a radar\'s latest scan is re-checked')
+
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.poll_interval)
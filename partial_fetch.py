@@ -0,0 +1,112 @@
+import bz2
+import zlib
+import struct
+
+import instrumentation
+import s3_controller
+
+# Level II archive layout (see pyart.io.nexrad_level2): a 24 byte volume header, then records that are each
+# a 4 byte size followed by a bzip2 stream of messages. Every message starts with a 12 byte CTM header.
+volume_header_size = 24
+ctm_size = 12
+msg_header_size = 16
+record_size = 2432  # Slot taken by every message type except 31
+elevation_number_offset = ctm_size + msg_header_size + 22  # In a message 31, counted from its CTM header
+
+first_chunk_bytes = 1024**2
+max_chunk_bytes = 8 * 1024**2
+
+class _RangedObject:
+    # Reads an S3 object front to back with ranged GETs, doubling the chunk size up to max_chunk_bytes
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.offset = 0
+        self.size = None
+        self.requests = 0
+        self._chunk = first_chunk_bytes
+
+    def _get(self, byte_range):
+        # The body is read inside the retried call, since the connection can also drop while it streams
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=byte_range)
+        return response, response['Body'].read()
+
+    def read(self):
+        """Returns the next chunk of the object, or b'' at its end."""
+        if self.size is not None and self.offset >= self.size:
+            return b''
+        response, data = s3_controller.call('get', self._get, f'bytes={self.offset}-{self.offset + self._chunk - 1}')
+        self.requests += 1
+
+        content_range = response.get('ContentRange')
+        self.size = int(content_range.rsplit('/', 1)[1]) if content_range else self.offset + len(data)  # No range support: whole object
+        self.offset += len(data)
+        self._chunk = min(self._chunk * 2, max_chunk_bytes)
+        return data
+
+def _max_elevation_number(messages):
+    # Highest elevation number among the radials (message 31) of one decompressed record, 0 if there are none
+    top, pos = 0, 0
+    while pos + elevation_number_offset < len(messages):
+        size, msg_type = struct.unpack_from('>HxB', messages, pos + ctm_size)
+        if msg_type == 31:
+            top = max(top, messages[pos + elevation_number_offset])
+            pos += ctm_size + 2 * size
+        else:
+            pos += record_size
+    return top
+
+def fetch_sweeps(s3, bucket, key, last_sweep):
+    """
+    Fetches only the start of a Level II volume, through the end of sweep `last_sweep` (0 based), with ranged
+    GETs. Low sweeps come first in the archive, so this is a fraction of the object. Records are decompressed as
+    they arrive to find where the sweep ends, and the result is returned in the uncompressed archive form
+    (volume header, then the plain messages), which pyart reads without decompressing anything again.
+    .gz objects are gunzipped as they stream in. Returns None for volumes that aren't split into bzip2 records
+    (archives from before 2008), which have to be downloaded whole.
+    """
+    source = _RangedObject(s3, bucket, key)
+    gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS) if key.endswith('.gz') else None
+    pending = bytearray()
+    header = None
+    records = []
+
+    with instrumentation.stage('download', source=key, partial=True) as record:
+        finished = False
+        while not finished:
+            chunk = source.read()
+            pending += gunzip.decompress(chunk) if gunzip else chunk
+            at_end = source.offset >= source.size  # The whole volume was needed
+
+            if header is None:
+                if len(pending) < volume_header_size + 6:
+                    if at_end:
+                        break
+                    continue
+                if pending[volume_header_size + 4:volume_header_size + 6] != b'BZ':
+                    return None
+                header = bytes(pending[:volume_header_size])
+                del pending[:volume_header_size]
+
+            # Decode every record that has fully arrived, stopping once one reaches past the last sweep
+            while len(pending) >= 4:
+                size = abs(struct.unpack_from('>i', pending)[0])
+                if len(pending) < 4 + size:
+                    break
+                messages = bz2.decompress(pending[4:4 + size])
+                del pending[:4 + size]
+                records.append(messages)
+                if _max_elevation_number(messages) > last_sweep + 1:
+                    finished = True
+                    break
+            finished = finished or at_end
+
+        record['bytes'] = source.offset
+        record['requests'] = source.requests
+        record['object_bytes'] = source.size
+
+    if header is None or not records:
+        return None
+    # pyart takes a zeroed first CTM header as the mark of an uncompressed archive
+    return header + bytes(ctm_size) + records[0][ctm_size:] + b''.join(records[1:])
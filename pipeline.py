@@ -0,0 +1,162 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import download
+import scheduler
+import visualize
+
+default_volume_bytes = 64 * 1024**2  # Assumed size of a volume until the first one has arrived
+
+class DiskBudget:
+    """
+    Bytes of downloaded volumes allowed at once, on disk (or in memory with stream mode). A volume's size is
+    only known once it arrives, so each admission reserves the largest size seen so far and is corrected
+    afterwards. One volume is always admitted, so a volume larger than the whole budget can't stall the
+    pipeline. `max_bytes` of None means no limit. Only used from the pipeline's coordinating thread.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.used = 0  # Reservations included
+        self.held = 0  # Only volumes that have arrived
+        self.peak = 0
+        self._largest = 0
+
+    @property
+    def estimate(self):
+        return self._largest or default_volume_bytes
+
+    def fits(self):
+        return self.max_bytes is None or self.used == 0 or self.used + self.estimate <= self.max_bytes
+
+    def reserve(self):
+        reserved = self.estimate
+        self.used += reserved
+        return reserved
+
+    def settle(self, reserved, actual):
+        # Swap the reservation for the volume's real size
+        self._largest = max(self._largest, actual)
+        self.used += actual - reserved
+        self.held += actual
+        self.peak = max(self.peak, self.held)
+
+    def release(self, nbytes):
+        self.used -= nbytes
+        self.held -= nbytes
+
+def _volume_bytes(downloaded):
+    if isinstance(downloaded, str):
+        return os.path.getsize(downloaded) if os.path.exists(downloaded) else 0
+    return downloaded.getbuffer().nbytes
+
+def run_pipeline(events, render_args, download_workers=4, render_workers=1, max_in_flight=8, budget=None, index=None, stream=False, cache=None,
+                 compressed_dir=download.compressed_dir, uncompressed_dir=download.uncompressed_dir, on_selected=None, on_downloaded=None, on_rendered=None, last_sweep=None):
+    """
+    Downloads and renders the scans for `events` with both stages running at once, so throughput approaches
+    the slower of the two instead of their sum. Radar-days are listed and scans shared between events as in
+    scheduler.schedule_downloads. At most `max_in_flight` scans are between the start of their download
+    and the end of their last render, and new downloads wait while the DiskBudget `budget` is full. Each
+    volume is deleted as soon as every event using it has been rendered.
+
+    `events` is a list of (year, month, day, radar_code, start_time) tuples and `render_args` holds one
+    (tornado_lat, tornado_lon, options) tuple per event for visualize_radar_data. Rendering always runs in
+    `render_workers` processes (at least one), leaving this thread free to keep downloads going.
+    With `last_sweep` set, volumes are only fetched through that sweep (see partial_fetch.py).
+    Callbacks: `on_selected(position, key)`, `on_downloaded(position, pairs, error)` once per event with
+    pairs as in schedule_downloads' results, and `on_rendered(position, key, error, sample)` per rendered file.
+    Returns stats on the scans downloaded and the peak bytes held.
+    """
+    s3 = download.get_s3_client(max_pool_connections=max(download_workers, 10))
+    budget = budget or DiskBudget()
+    if not stream:
+        os.makedirs(compressed_dir, exist_ok=True)
+        os.makedirs(uncompressed_dir, exist_ok=True)
+
+    options = render_args[0][2] if render_args else {}
+    visualize.preload('numpy' if options.get('return_sample') else options.get('engine', 'matplotlib'))
+
+    with visualize.render_pool(max(render_workers, 1)) as renders:
+        # Start the workers before any download thread exists; forking a threaded process can deadlock the child
+        renders.submit(os.getpid).result()
+
+        with ThreadPoolExecutor(max_workers=download_workers) as downloads:
+            # 1. Listings are small, so every radar-day is listed up front without throttling
+            event_keys, errors, _ = scheduler.select_scans(events, downloads, s3, index, on_selected)
+            for idx in range(len(events)):
+                if idx not in event_keys and on_downloaded:
+                    on_downloaded(idx, [], errors.get(idx))
+
+            events_by_key = {}
+            for idx, key in sorted(event_keys.items()):
+                events_by_key.setdefault(key, []).append(idx)
+
+            pending = deque(events_by_key)
+            active = {}  # future -> (key, event position or None for a download, reserved bytes)
+            volumes = {}  # key -> [downloaded files, renders left, bytes]
+            in_flight = 0
+
+            def finish(key, downloaded, nbytes):
+                nonlocal in_flight
+                for file in downloaded:
+                    if isinstance(file, str) and os.path.exists(file):
+                        os.remove(file)
+                budget.release(nbytes)
+                in_flight -= 1
+
+            # 2. Admit downloads within the limits, and hand each finished one straight to the render workers
+            while pending or active:
+                while pending and in_flight < max_in_flight and budget.fits():
+                    key = pending.popleft()
+                    future = downloads.submit(scheduler.fetch_scan, key, compressed_dir, uncompressed_dir, s3, stream, cache, last_sweep)
+                    active[future] = (key, None, budget.reserve())
+                    in_flight += 1
+
+                done, _ = wait(active, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, position, reserved = active.pop(future)
+
+                    if position is None:
+                        try:
+                            downloaded, error = future.result(), None
+                        except Exception as e:
+                            downloaded, error = [], e
+                        nbytes = sum(_volume_bytes(file) for file in downloaded)
+                        budget.settle(reserved, nbytes)
+
+                        members = events_by_key[key]
+                        for idx in members:
+                            if on_downloaded:
+                                on_downloaded(idx, [(key, file) for file in downloaded], error)
+
+                        tasks = [(idx, file) for idx in members for file in downloaded]
+                        if not tasks:
+                            finish(key, downloaded, nbytes)
+                            continue
+                        volumes[key] = [downloaded, len(tasks), nbytes]
+                        for idx, file in tasks:
+                            tornado_lat, tornado_lon, render_options = render_args[idx]
+                            task = (file, visualize.image_directory, tornado_lat, tornado_lon, render_options)
+                            active[renders.submit(visualize.render_task, task)] = (key, idx, 0)
+                        continue
+
+                    try:
+                        _, error, sample = future.result()
+                    except Exception as e:  # A worker died (e.g. killed for memory)
+                        error, sample = f"{type(e).__name__}: {e}", None
+                    if on_rendered:
+                        on_rendered(position, key, error, sample)
+
+                    volume = volumes[key]
+                    volume[1] -= 1
+                    if volume[1] == 0:
+                        del volumes[key]
+                        finish(key, volume[0], volume[2])
+
+    return {
+        'events': len(events),
+        'events_with_scan': len(event_keys),
+        'distinct_scans': len(events_by_key),
+        'peak_bytes': budget.peak,
+    }
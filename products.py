@@ -0,0 +1,35 @@
+# A product is one (field, volume sweep) pair, rendered as one channel of a sample.
+# All products of a spec come from a single read of the volume and are rasterized onto the same pixels.
+
+# pyart colormap and value range of each Level II moment; values outside the range are clipped
+field_scales = {
+    'velocity': ('NWSVel', -60.0, 60.0),
+    'reflectivity': ('NWSRef', -32.0, 64.0),
+    'spectrum_width': ('NWS_SPW', 0.0, 30.0),
+    'differential_reflectivity': ('RefDiff', -2.0, 8.0),
+    'cross_correlation_ratio': ('Carbone42', 0.2, 1.05),
+    'differential_phase': ('Wild25', 0.0, 360.0),
+}
+
+# The velocity of the fourth sweep, what the pipeline has always rendered
+default_products = [('velocity', 3)]
+
+def parse_products(spec):
+    """Parses "field:sweep,field:sweep,..." (e.g. "velocity:3,reflectivity:0") into a list of (field, sweep) pairs."""
+    products = []
+    for item in spec.split(','):
+        field, _, sweep = item.strip().partition(':')
+        if field not in field_scales:
+            raise ValueError(f"Unknown field {field!r}, expected one of {', '.join(field_scales)}")
+        if not sweep.isdigit():
+            raise ValueError(f"Expected field:sweep, got {item.strip()!r}")
+        products.append((field, int(sweep)))
+    if len(set(products)) != len(products):
+        raise ValueError(f"Repeated product in {spec!r}")
+    return products
+
+def channel_names(products):
+    # The default product keeps its plain name, so existing file names don't change
+    if products == default_products:
+        return ['velocity']
+    return [f"{field}{sweep}" for field, sweep in products]
@@ -0,0 +1,71 @@
+import threading
+
+import numpy as np
+
+radar_csv = 'radar_locations.csv'
+earth_radius_km = 6371.0
+candidate_count = 3  # Radars considered for each location, nearest first
+max_candidate_km = 230.0  # Range of the velocity data; farther radars don't cover the location
+
+def _unit_vectors(lats, lons):
+    # Points on the unit sphere (earth-centred coordinates), where straight-line neighbours are also great-circle neighbours
+    lats, lons = np.radians(np.asarray(lats, dtype=np.float64)), np.radians(np.asarray(lons, dtype=np.float64))
+    return np.stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)], axis=-1)
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+class RadarIndex:
+    """
+    Geodesic nearest-radar lookup. Sites are stored as earth-centred unit vectors in a KDTree, so the
+    chord distance it measures ranks radars exactly like great-circle distance (unlike raw lat/lon degrees,
+    which stretch east-west distances at high latitudes). Distances are returned in km.
+    """
+
+    def __init__(self, path=radar_csv):
+        # pandas and scipy are imported here, so importing this module stays cheap
+        import pandas as pd
+        from scipy.spatial import KDTree
+
+        self.sites = pd.read_csv(path)
+        self.codes = self.sites['RadarCode'].to_numpy()
+        self._lats = self.sites['Latitude'].to_numpy()
+        self._lons = self.sites['Longitude'].to_numpy()
+        self._tree = KDTree(_unit_vectors(self._lats, self._lons))
+
+    def query(self, lats, lons, k=candidate_count):
+        """Returns (codes, distances_km), both shaped (n, k), for n locations, nearest radar first."""
+        lats, lons = np.atleast_1d(lats), np.atleast_1d(lons)
+        k = min(k, len(self.codes))
+        _, indices = self._tree.query(_unit_vectors(lats, lons), k=k)
+        indices = indices.reshape(len(lats), k)
+        distances = haversine_km(lats[:, np.newaxis], lons[:, np.newaxis], self._lats[indices], self._lons[indices])
+        return self.codes[indices], distances
+
+    def candidates(self, lats, lons, k=candidate_count, max_km=max_candidate_km):
+        """Returns one [(radar code, km), ...] list per location, nearest first, dropping all but the nearest beyond max_km."""
+        codes, distances = self.query(lats, lons, k)
+        return [
+            [(code, float(km)) for i, (code, km) in enumerate(zip(row_codes, row_km)) if i == 0 or km <= max_km]
+            for row_codes, row_km in zip(codes, distances)
+        ]
+
+def format_candidates(candidates):
+    # One "KTLX:12.3;KVNX:140.8" string per location, as stored in the 'Candidate Radars' column
+    return [';'.join(f"{code}:{km:.1f}" for code, km in row) for row in candidates]
+
+def parse_candidates(value):
+    return [(code, float(km)) for code, km in (item.split(':') for item in value.split(';'))]
+
+_default = None
+_default_lock = threading.Lock()
+
+def default_index():
+    # Shared index over radar_locations.csv, built on first use
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = RadarIndex()
+        return _default
@@ -0,0 +1,39 @@
+import os
+import sys
+
+_pyart = None
+
+def import_pyart():
+    """
+    Imports pyart on first use, hiding the banner it prints, and returns the module.
+    pyart pulls in matplotlib and scipy and takes seconds to import, so modules call this
+    from the code paths that need it rather than importing it at the top.
+    """
+    global _pyart
+    if _pyart is None:
+        backup = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            import pyart
+        finally:
+            sys.stdout.close()
+            sys.stdout = backup
+        _pyart = pyart
+    return _pyart
+
+def read_sweeps(source, sweeps, fields):
+    """
+    Reads a Level II archive (path or file-like object), decoding only the given sweeps and fields.
+    This saves less than it sounds: pyart still bz2-decompresses the whole volume and parses every
+    message before it selects anything, and that is about 90% of a read. Skipping the other sweeps and
+    fields only saves building their arrays, 7-15% of a read in benchmark.py. The remaining cost is cut
+    by partial_fetch.py (a shorter, already decompressed archive) and sweep_cache.py (no decode).
+
+    Returns (radar, sweep_map): a pyart Radar holding just the requested sweeps, and a dict mapping
+    each requested volume sweep number to its index in that Radar. The gate dimension is trimmed
+    to the longest selected sweep, so `radar.range` can be shorter than in a full read.
+    """
+    scans = sorted(set(sweeps))
+    radar = import_pyart().io.read_nexrad_archive(source, include_fields=list(fields), scans=scans)
+    sweep_map = {sweep: idx for idx, sweep in enumerate(scans)}
+    return radar, sweep_map
@@ -0,0 +1,110 @@
+import numpy as np
+
+# Effective earth radius (4/3 model), the same one pyart uses to place gates
+effective_earth_radius = 6371000.0 * 4.0 / 3.0
+km_per_degree = 111.0
+image_size = 224
+
+_lut_cache = {}
+
+def colormap_lut(cmap, n=256):
+    """
+    Samples a matplotlib colormap into an (n, 3) uint8 table, with one extra white row at index n for
+    missing data (the figure background in the matplotlib renderer). Tables are built once per colormap.
+    """
+    name = getattr(cmap, 'name', id(cmap))
+    if name not in _lut_cache:
+        colors = np.asarray(cmap(np.linspace(0.0, 1.0, n)))[:, :3]
+        lut = np.empty((n + 1, 3), dtype=np.uint8)
+        lut[:n] = np.round(colors * 255)
+        lut[n] = 255
+        _lut_cache[name] = lut
+    return _lut_cache[name]
+
+def ground_range(ranges, elevation):
+    # Distance along the ground to each gate, following pyart's antenna_to_cartesian
+    theta_e = np.radians(elevation)
+    z = np.sqrt(ranges**2 + effective_earth_radius**2 + 2.0 * ranges * effective_earth_radius * np.sin(theta_e)) - effective_earth_radius
+    return effective_earth_radius * np.arcsin(ranges * np.cos(theta_e) / (effective_earth_radius + z))
+
+def _nearest_sorted(values, queries):
+    # Index of the nearest entry of a sorted 1-D array for every query
+    pos = np.clip(np.searchsorted(values, queries), 1, len(values) - 1)
+    left = values[pos - 1]
+    right = values[pos]
+    return np.where(queries - left <= right - queries, pos - 1, pos)
+
+def gate_indices(azimuths, ranges, elevation, radar_lat, radar_lon, center_lat, center_lon, half_extent_deg, size=image_size):
+    """
+    Maps every pixel of a size x size image centred on (center_lat, center_lon) and spanning
+    +/- half_extent_deg in both lat and lon to the flat index (ray * ngates + gate) of the nearest gate.
+    Pixels outside the sweep get -1. The flat-earth lat/lon conversion is the inverse of the one the
+    matplotlib renderer uses, so both engines place the data identically.
+    """
+    azimuths = np.asarray(azimuths, dtype=np.float64) % 360.0
+    ranges = np.asarray(ranges, dtype=np.float64)
+
+    # Pixel centres, top row first like an image
+    offsets = (np.arange(size) + 0.5) / size * 2.0 - 1.0
+    lats = center_lat - offsets * half_extent_deg
+    lons = center_lon + offsets * half_extent_deg
+
+    x = (lons[np.newaxis, :] - radar_lon) * km_per_degree * np.cos(np.radians(radar_lat)) * 1000.0
+    y = (lats[:, np.newaxis] - radar_lat) * km_per_degree * 1000.0
+    pixel_azimuth = np.degrees(np.arctan2(x, y)) % 360.0
+    pixel_distance = np.hypot(x, y)
+
+    # Nearest ray, wrapping around north
+    order = np.argsort(azimuths)
+    sorted_az = azimuths[order]
+    wrapped_az = np.concatenate([sorted_az[-1:] - 360.0, sorted_az, sorted_az[:1] + 360.0])
+    wrapped_order = np.concatenate([order[-1:], order, order[:1]])
+    rays = wrapped_order[_nearest_sorted(wrapped_az, pixel_azimuth)]
+
+    # Nearest gate along the ground
+    gate_ground = ground_range(ranges, elevation)
+    gates = _nearest_sorted(gate_ground, pixel_distance)
+    half_spacing = (gate_ground[-1] - gate_ground[0]) / max(len(gate_ground) - 1, 1) / 2.0
+    outside = (pixel_distance < gate_ground[0] - half_spacing) | (pixel_distance > gate_ground[-1] + half_spacing)
+
+    indices = rays * len(ranges) + gates
+    indices[outside] = -1
+    return indices
+
+def crop_indices(grid_size, grid_half_extent_deg, half_extent_deg, lat_offset, lon_offset, rotation_deg=0.0, size=image_size):
+    """
+    Maps every pixel of a size x size crop to the flat index of the nearest pixel of a larger grid_size x
+    grid_size grid laid out like gate_indices, both spanning +/- their half extent. The crop is centred
+    `lat_offset`/`lon_offset` degrees from the grid's centre, with the map turned `rotation_deg` counterclockwise, so
+    several crops can be cut from one rasterized grid. The crop must lie inside the grid.
+    """
+    offsets = (np.arange(size) + 0.5) / size * 2.0 - 1.0
+    dlat = -offsets[:, np.newaxis] * half_extent_deg
+    dlon = offsets[np.newaxis, :] * half_extent_deg
+
+    theta = np.radians(rotation_deg)
+    lats = lat_offset + dlat * np.cos(theta) - dlon * np.sin(theta)
+    lons = lon_offset + dlat * np.sin(theta) + dlon * np.cos(theta)
+
+    rows = np.round((1.0 - lats / grid_half_extent_deg) / 2.0 * grid_size - 0.5).astype(np.intp)
+    cols = np.round((1.0 + lons / grid_half_extent_deg) / 2.0 * grid_size - 0.5).astype(np.intp)
+    return np.clip(rows, 0, grid_size - 1) * grid_size + np.clip(cols, 0, grid_size - 1)
+
+def sample_field(data, indices):
+    """Samples a (rays, gates) field through precomputed pixel indices, with NaN wherever there is no data."""
+    values = np.ma.filled(np.ma.asarray(data, dtype=np.float64), np.nan).ravel()
+    values = np.append(values, np.nan)  # Index -1 lands on this missing value
+    return values[indices]
+
+def colorize(values, lut, vmin, vmax):
+    """Colours a grid of field values into an RGB uint8 image, clipping to [vmin, vmax] like matplotlib."""
+    n = len(lut) - 1
+    missing = np.isnan(values)
+    scaled = (np.where(missing, vmin, values) - vmin) / (vmax - vmin) * n
+    color_idx = np.clip(scaled, 0, n - 1).astype(np.intp)
+    color_idx[missing] = n
+    return lut[color_idx]
+
+def render_field(data, indices, lut, vmin, vmax):
+    """Colours a (rays, gates) field through precomputed pixel indices into an RGB uint8 image."""
+    return colorize(sample_field(data, indices), lut, vmin, vmax)
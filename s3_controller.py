@@ -0,0 +1,154 @@
+import time
+import random
+import threading
+
+# Error codes S3 (and stand-ins) use when asking clients to slow down, and ones that are worth a retry
+throttle_codes = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests', 'RequestThrottled', 'ServiceUnavailable', '503', '429'}
+transient_codes = {'InternalError', 'RequestTimeout', '500', '502', '504'}
+
+default_max_attempts = {'list': 8, 'download': 8, 'get': 8}  # Attempts per call, by operation (other operations get 4)
+
+def classify(error):
+    """Returns 'throttle' or 'transient' for errors worth retrying, None for ones that won't go away (e.g. a missing key)."""
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = str(response.get('Error', {}).get('Code', ''))
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        if code in throttle_codes or status in (429, 503):
+            return 'throttle'
+        if code in transient_codes or status >= 500:
+            return 'transient'
+        return None
+
+    # Dropped connections, timeouts and bodies cut short; botocore is only imported once a call has failed
+    from botocore import exceptions
+    if isinstance(error, (ConnectionError, TimeoutError, exceptions.HTTPClientError, exceptions.ConnectionError, exceptions.IncompleteReadError)):
+        return 'transient'
+    return None
+
+class RequestController:
+    """
+    Runs S3 calls with retries under a shared, adaptive limit on how many run at once.
+    A call that fails with a throttle or transient error (see classify) is retried after a full-jitter
+    exponential backoff, up to the operation's attempt limit. Retries of transient errors also need the
+    operation's retry budget: each spends a token and every success earns back `retry_ratio` of one, so in an
+    outage retries dry up instead of multiplying the load. Throttled calls don't spend tokens, since the
+    concurrency limit already slows them down. The concurrency limit works like TCP congestion control, counted
+    in requests rather than seconds: it halves on throttling, at most once per window, since the requests that
+    were already in flight when it halved were sent at the old limit and their SlowDowns say nothing new. After
+    a throttle it holds until a full `limit` of requests in a row succeed, then grows by about one per `limit`
+    successes. Calls over the limit wait. Counters are kept per operation, see stats().
+    """
+
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=64, base_delay=0.1, max_delay=20.0, max_attempts=None, retry_capacity=50, retry_ratio=0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = dict(default_max_attempts, **(max_attempts or {}))
+        self.retry_capacity = retry_capacity
+        self.retry_ratio = retry_ratio
+
+        self._condition = threading.Condition()
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._sent = 0  # Requests started so far; each call's number orders it against the last decrease
+        self._window_end = 0  # Requests numbered up to here were sent before the limit last halved
+        self._clean = 0  # Successes in a row since the last throttle
+        self._tokens = {}  # operation -> retry tokens left
+        self._counters = {}  # operation -> counters
+
+    def call(self, operation, fn, *args, **kwargs):
+        """Calls fn(*args, **kwargs), retrying transient failures; raises the last error once retries run out."""
+        attempt = 1
+        while True:
+            number = self._acquire(operation)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                self._release(operation, kind or 'error', number)
+                if kind is None or not self._take_retry(operation, attempt, kind):
+                    self._count(operation, 'failures')
+                    raise
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))))
+                attempt += 1
+                continue
+            self._release(operation, 'success', number)
+            return result
+
+    def _acquire(self, operation):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+            self._sent += 1
+            self._counter(operation)['requests'] += 1
+            return self._sent
+
+    def _release(self, operation, outcome, number):
+        with self._condition:
+            self._in_flight -= 1
+            counters = self._counter(operation)
+            if outcome == 'success':
+                counters['successes'] += 1
+                self._clean += 1
+                if self._clean > self._limit:
+                    self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+                self._tokens[operation] = min(self.retry_capacity, self._tokens.get(operation, self.retry_capacity) + self.retry_ratio)
+            elif outcome == 'throttle':
+                counters['throttles'] += 1
+                self._clean = 0
+                if number > self._window_end:
+                    self._limit = max(self.min_limit, self._limit / 2)
+                    self._window_end = self._sent
+            elif outcome == 'transient':
+                counters['transient_errors'] += 1
+            self._condition.notify_all()
+
+    def _take_retry(self, operation, attempt, kind):
+        with self._condition:
+            if attempt >= self.max_attempts.get(operation, 4):
+                return False
+            if kind == 'throttle':
+                self._counter(operation)['retries'] += 1
+                return True
+            tokens = self._tokens.get(operation, self.retry_capacity)
+            if tokens < 1:
+                self._counter(operation)['budget_exhausted'] += 1
+                return False
+            self._tokens[operation] = tokens - 1
+            self._counter(operation)['retries'] += 1
+            return True
+
+    def _counter(self, operation):
+        # Must be called with the lock held
+        if operation not in self._counters:
+            self._counters[operation] = dict.fromkeys(('requests', 'successes', 'retries', 'throttles', 'transient_errors', 'failures', 'budget_exhausted'), 0)
+        return self._counters[operation]
+
+    def _count(self, operation, name):
+        with self._condition:
+            self._counter(operation)[name] += 1
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': round(self._limit, 1),
+                'in_flight': self._in_flight,
+                'operations': {operation: dict(counters) for operation, counters in self._counters.items()},
+            }
+
+# Shared by download.py, partial_fetch.py and child_pr.py; call configure() to change its settings
+default_controller = RequestController()
+
+def configure(**settings):
+    global default_controller
+    default_controller = RequestController(**settings)
+    return default_controller
+
+def call(operation, fn, *args, **kwargs):
+    return default_controller.call(operation, fn, *args, **kwargs)
+
+def stats():
+    return default_controller.stats()
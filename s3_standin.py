@@ -0,0 +1,252 @@
+import os
+import re
+import time
+import random
+import hashlib
+import argparse
+import threading
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
+from xml.sax.saxutils import escape
+
+class S3StandIn:
+    """
+    A small local S3 server covering what this project calls: ListObjectsV2 (prefix, delimiter,
+    start-after, pagination), HeadObject and GetObject with byte ranges. Objects live in memory as bytes or as paths
+    to files on disk. Point download.py at it with NEXRAD_S3_ENDPOINT_URL=<url>.
+    `latency` adds a fixed delay to every request to mimic a round trip to the real bucket, and `stats`
+    counts requests per operation and the bytes served. To exercise retries, requests beyond `max_concurrent`
+    in flight get a 503 SlowDown like a throttled bucket, and `error_rate` of them fail with a 500 InternalError.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, max_concurrent=None, error_rate=0.0):
+        self.latency = latency
+        self.max_concurrent = max_concurrent
+        self.error_rate = error_rate
+        self._objects = {}
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.stats = {'list': 0, 'head': 0, 'get': 0, 'bytes_sent': 0, 'throttled': 0, 'errors': 0}
+
+        standin = self
+
+        class Handler(_Handler):
+            server_state = standin
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def put(self, bucket, key, data):
+        """Adds an object; `data` is bytes or the path of a file to serve."""
+        with self._lock:
+            self._objects.setdefault(bucket, {})[key] = data
+
+    def put_directory(self, bucket, directory):
+        # Every file below `directory` becomes an object keyed by its relative path
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                self.put(bucket, os.path.relpath(path, directory).replace(os.sep, '/'), path)
+
+    def _count(self, op, nbytes=0):
+        with self._lock:
+            self.stats[op] += 1
+            self.stats['bytes_sent'] += nbytes
+
+    def _admit(self):
+        # Returns the (status, code) to fail a new request with, or None to serve it (then call _done)
+        with self._lock:
+            if self.max_concurrent is not None and self._in_flight >= self.max_concurrent:
+                self.stats['throttled'] += 1
+                return 503, 'SlowDown'
+            if self.error_rate and random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return 500, 'InternalError'
+            self._in_flight += 1
+            return None
+
+    def _done(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _keys(self, bucket):
+        with self._lock:
+            objects = self._objects.get(bucket)
+            return None if objects is None else sorted(objects)
+
+    def _read(self, bucket, key):
+        with self._lock:
+            data = self._objects.get(bucket, {}).get(key)
+        if isinstance(data, str):
+            with open(data, 'rb') as f:
+                return f.read()
+        return data
+
+    def _size(self, bucket, key):
+        with self._lock:
+            data = self._objects[bucket][key]
+        return os.path.getsize(data) if isinstance(data, str) else len(data)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+    server_state = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _split(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        return bucket, unquote(key), parse_qs(url.query)
+
+    def _send(self, status, body=b'', headers=None, head_only=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def _error(self, status, code, head_only=False):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code></Error>'.encode()
+        self._send(status, body, {'Content-Type': 'application/xml'}, head_only)
+
+    def _handle(self, serve, head_only=False):
+        state = self.server_state
+        rejection = state._admit()
+        if rejection:
+            time.sleep(state.latency)
+            self._error(*rejection, head_only)
+            return
+        try:
+            serve()
+        finally:
+            state._done()
+
+    def do_HEAD(self):
+        self._handle(lambda: self._object(head_only=True), head_only=True)
+
+    def do_GET(self):
+        bucket, key, query = self._split()
+        if key:
+            self._handle(self._object)
+        else:
+            self._handle(lambda: self._list(bucket, query))
+
+    def _list(self, bucket, query):
+        state = self.server_state
+        time.sleep(state.latency)
+        keys = state._keys(bucket)
+        if keys is None:
+            self._error(404, 'NoSuchBucket')
+            return
+
+        prefix = query.get('prefix', [''])[0]
+        start_after = query.get('continuation-token', query.get('start-after', ['']))[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        delimiter = query.get('delimiter', [''])[0]
+        url_encode = query.get('encoding-type', [''])[0] == 'url'
+        encode = quote if url_encode else escape
+
+        # With a delimiter, keys below the next delimiter roll up into one common prefix entry
+        entries = []  # (key or common prefix, is_prefix)
+        for k in keys:
+            if not k.startswith(prefix) or k <= start_after:
+                continue
+            cut = k.find(delimiter, len(prefix)) if delimiter else -1
+            entry = (k[:cut + len(delimiter)], True) if cut >= 0 else (k, False)
+            if not entries or entries[-1] != entry:
+                entries.append(entry)
+        page, truncated = entries[:max_keys], len(entries) > max_keys
+
+        contents = ''.join(
+            f'<CommonPrefixes><Prefix>{encode(k)}</Prefix></CommonPrefixes>' if is_prefix else
+            f'<Contents><Key>{encode(k)}</Key><Size>{state._size(bucket, k)}</Size>'
+            f'<LastModified>2000-01-01T00:00:00.000Z</LastModified><StorageClass>STANDARD</StorageClass></Contents>'
+            for k, is_prefix in page
+        )
+        # A token after a common prefix sorts past every key below it
+        if truncated:
+            last, is_prefix = page[-1]
+            token = f'<NextContinuationToken>{escape(last + chr(0x10FFFF) if is_prefix else last)}</NextContinuationToken>'
+        else:
+            token = ''
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f'<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>'
+            f'<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{"true" if truncated else "false"}</IsTruncated>'
+            f'{"<EncodingType>url</EncodingType>" if url_encode else ""}{token}{contents}</ListBucketResult>'
+        ).encode()
+        state._count('list', len(body))
+        self._send(200, body, {'Content-Type': 'application/xml'})
+
+    def _object(self, head_only=False):
+        state = self.server_state
+        time.sleep(state.latency)
+        bucket, key, _ = self._split()
+        data = state._read(bucket, key)
+        if data is None:
+            self._error(404, 'NoSuchKey', head_only)
+            return
+
+        headers = {
+            'ETag': '"' + hashlib.md5(data).hexdigest() + '"',
+            'Last-Modified': formatdate(0, usegmt=True),
+            'Accept-Ranges': 'bytes',
+            'Content-Type': 'binary/octet-stream',
+        }
+        status, body = 200, data
+
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last) if last else len(data) - 1, len(data) - 1)
+            else:
+                start, end = max(len(data) - int(last), 0), len(data) - 1
+            if start >= len(data):
+                self._error(416, 'InvalidRange', head_only)
+                return
+            status, body = 206, data[start:end + 1]
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+
+        state._count('head' if head_only else 'get', 0 if head_only else len(body))
+        self._send(status, body, headers, head_only)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a directory as a local S3 bucket')
+    parser.add_argument('directory', help='Directory whose files become objects, keyed by relative path')
+    parser.add_argument('--bucket', default='noaa-nexrad-level2', help='Bucket name to serve them under')
+    parser.add_argument('--port', type=int, default=9000, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of delay added to every request')
+    parser.add_argument('--max-concurrent', type=int, help='Throttle (503 SlowDown) requests beyond this many at once')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail with a 500 InternalError')
+
+    args = parser.parse_args()
+
+    standin = S3StandIn(port=args.port, latency=args.latency, max_concurrent=args.max_concurrent, error_rate=args.error_rate)
+    standin.put_directory(args.bucket, args.directory)
+    print(f"Serving {args.directory} as s3://{args.bucket} on {standin.url}")
+    print(f"Set NEXRAD_S3_ENDPOINT_URL={standin.url} to use it.")
+    try:
+        standin._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
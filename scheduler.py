@@ -0,0 +1,140 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import download
+
+def _list_radar_day(radar_code, year, month, day, s3, index):
+    prefix = f'{year}/{month:02}/{day:02}/{radar_code}'
+
+    if index is not None:
+        scans = index.get_scans(radar_code, year, month, day)
+        if scans is None:
+            scans = index.store(radar_code, year, month, day, download.list_files(download.bucket_name, prefix, s3))
+        return scans
+
+    return download.list_files(download.bucket_name, prefix, s3)
+
+def fetch_scan(key, compressed_dir, uncompressed_dir, s3, stream, cache, last_sweep=None):
+    if stream:
+        return download.download_selected_files_to_memory([key], download.bucket_name, s3, cache, last_sweep)
+    return download.download_selected_files([key], download.bucket_name, compressed_dir, uncompressed_dir, s3, cache, last_sweep)
+
+def select_scans(events, executor, s3, index=None, on_selected=None):
+    """
+    Lists each radar-day of `events` once, on `executor`, and picks every event's scan from the shared listing.
+    Events that already carry a scan key (an optional sixth item) keep it and aren't listed.
+    Returns (event_keys, errors, groups): the selected S3 key by event position, the listing error by
+    event position for radar-days that couldn't be listed, and the event positions of each listed radar-day.
+    Events in neither dict have no scan. `on_selected` is called with (event position, S3 key) for new picks.
+    """
+    groups = {}
+    event_keys = {}
+    errors = {}
+    for idx, event in enumerate(events):
+        year, month, day, radar_code = event[:4]
+        if len(event) > 5 and event[5]:
+            event_keys[idx] = event[5]
+        else:
+            groups.setdefault((radar_code, year, month, day), []).append(idx)
+
+    listings = {executor.submit(_list_radar_day, *group, s3, index): group for group in groups}
+    for future in as_completed(listings):
+        group = listings[future]
+        radar_code, year, month, day = group
+        members = groups[group]
+
+        try:
+            listing = future.result()
+        except Exception as e:
+            for idx in members:
+                errors[idx] = e
+            continue
+
+        if not (listing[1] if index is not None else listing):
+            print(f"No files found for {radar_code} on {year}-{month:02}-{day:02}.")
+            continue
+
+        for idx in members:
+            start_time = events[idx][4]
+            if index is not None:
+                selected_files = index.select_files(listing, start_time)
+            else:
+                selected_files = download.filter_files_based_on_time(listing, start_time)
+            if selected_files:
+                event_keys[idx] = selected_files[0]
+                if on_selected:
+                    on_selected(idx, selected_files[0])
+
+    return event_keys, errors, groups
+
+def _share(downloaded):
+    # Every event gets its own read position over the same in-memory volume; files on disk are shared as is
+    if isinstance(downloaded, str):
+        return downloaded
+    clone = io.BytesIO(downloaded.getvalue())
+    clone.name = downloaded.name
+    return clone
+
+def schedule_downloads(events, workers=8, compressed_dir='compressed_files', uncompressed_dir='uncompressed_files', index=None, stream=False, cache=None, on_complete=None, on_selected=None, last_sweep=None):
+    """
+    Downloads the scans for a batch of events while doing each piece of S3 work only once.
+    Events are grouped by (radar, date) so every prefix is listed once, and each distinct scan
+    is downloaded once and then handed to every event that selected it.
+
+    `events` is a list of (year, month, day, radar_code, start_time) tuples, optionally followed by the S3 key
+    of a scan picked by an earlier run (see select_scans). Returns (results, stats):
+    results holds one (pairs, error) entry per event in order, where pairs is a list of
+    (S3 key, file) for the event's scans; stats counts the work saved.
+    `on_complete` is called with the number of events finished each time some complete, and
+    `on_selected` with (event position, S3 key) once an event's scan has been picked. With `last_sweep` set,
+    only the start of each volume through that sweep is fetched (see partial_fetch.py).
+    """
+    s3 = download.get_s3_client(max_pool_connections=max(workers, 10))
+    results = [([], None) for _ in events]
+
+    if not stream:
+        os.makedirs(compressed_dir, exist_ok=True)
+        os.makedirs(uncompressed_dir, exist_ok=True)
+
+    def done(count):
+        if on_complete and count:
+            on_complete(count)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # 1. List each radar-day once and pick every event's scan from the shared listing
+        event_keys, errors, groups = select_scans(events, executor, s3, index, on_selected)
+        for idx, error in errors.items():
+            results[idx] = ([], error)
+        done(len(events) - len(event_keys))
+
+        # 2. Download each distinct scan once and fan it out to its events
+        events_by_key = {}
+        for idx, key in event_keys.items():
+            events_by_key.setdefault(key, []).append(idx)
+
+        fetches = {
+            executor.submit(fetch_scan, key, compressed_dir, uncompressed_dir, s3, stream, cache, last_sweep): key
+            for key in events_by_key
+        }
+        for future in as_completed(fetches):
+            key = fetches[future]
+            members = events_by_key[key]
+            try:
+                downloaded = future.result()
+                for idx in members:
+                    results[idx] = ([(key, _share(file)) for file in downloaded], None)
+            except Exception as e:
+                for idx in members:
+                    results[idx] = ([], e)
+            done(len(members))
+
+    stats = {
+        'events': len(events),
+        'radar_days': len(groups),
+        'list_calls_saved': len(events) - len(groups),
+        'events_with_scan': len(event_keys),
+        'distinct_scans': len(events_by_key),
+        'downloads_saved': len(event_keys) - len(events_by_key),
+    }
+    return results, stats
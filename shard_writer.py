@@ -0,0 +1,138 @@
+import os
+import re
+import csv
+import json
+import numpy as np
+
+shard_directory = 'radar_shards'
+
+# Velocity is stored as uint8: 0 means no data, 1..255 cover vmin..vmax linearly
+velocity_vmin, velocity_vmax = -60.0, 60.0
+
+index_columns = ['shard', 'row', 'event_id', 'radar_code', 'scan_time', 'event_time', 'tornado_lat', 'tornado_lon', 'lat_offset', 'lon_offset', 'rotation', 'source_key']
+
+def quantize(values, vmin, vmax):
+    """Packs a float grid (NaN for missing) into uint8: 0 means no data, 1..255 cover vmin..vmax linearly."""
+    missing = np.isnan(values)
+    scaled = np.round((np.clip(np.where(missing, vmin, values), vmin, vmax) - vmin) / (vmax - vmin) * 254) + 1
+    quantized = scaled.astype(np.uint8)
+    quantized[missing] = 0
+    return quantized
+
+def dequantize(quantized, vmin, vmax):
+    values = (quantized.astype(np.float32) - 1) / 254 * (vmax - vmin) + vmin
+    values[quantized == 0] = np.nan
+    return values
+
+def quantize_velocity(values, vmin=velocity_vmin, vmax=velocity_vmax):
+    return quantize(values, vmin, vmax)
+
+def dequantize_velocity(quantized, vmin=velocity_vmin, vmax=velocity_vmax):
+    return dequantize(quantized, vmin, vmax)
+
+class ShardWriter:
+    """
+    Appends 224x224 samples to fixed-size, memory-mappable .npy shards instead of writing one PNG each.
+    Every shard is three files: `<name>.images.npy` (N, 224, 224, 3) uint8 RGB, `<name>.velocity.npy`
+    (N, 224, 224) quantized uint8 velocity, and `<name>.index.csv`, with one row per sample describing
+    where it came from. The index is written once its shard is complete, so a listed shard is always
+    whole. Load shards with np.load(path, mmap_mode='r').
+    With `channels`, a list of (name, vmin, vmax) for several products (see products.py), the velocity file is
+    replaced by `<name>.channels.npy` (N, C, 224, 224) holding each product quantized over its own range.
+    `on_shard_written`, if given, is called with the shard's index rows once the shard is on disk.
+    """
+
+    def __init__(self, directory=shard_directory, shard_size=4096, prefix='shard', image_size=224, on_shard_written=None, channels=None):
+        self.directory = directory
+        self.channels = channels
+        self.on_shard_written = on_shard_written
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.image_size = image_size
+        self.samples_written = 0
+
+        self._shard_number = self._next_shard_number()
+        self._images = None
+        self._velocity = None
+        self._rows = []
+
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'format.json'), 'w') as f:
+            json.dump({
+                'image_size': image_size,
+                'velocity_vmin': velocity_vmin,
+                'velocity_vmax': velocity_vmax,
+                'velocity_missing': 0,
+                'index_columns': index_columns,
+                'channels': [{'name': name, 'vmin': vmin, 'vmax': vmax, 'missing': 0} for name, vmin, vmax in channels or []],
+            }, f, indent=2)
+
+    def _next_shard_number(self):
+        # Continue after any shards a previous run already finished
+        if not os.path.isdir(self.directory):
+            return 0
+        pattern = re.compile(re.escape(self.prefix) + r'-(\d+)\.index\.csv')
+        numbers = [int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(self.directory)) if match]
+        return max(numbers) + 1 if numbers else 0
+
+    def _shard_name(self):
+        return f"{self.prefix}-{self._shard_number:05}"
+
+    def _open_shard(self):
+        base = os.path.join(self.directory, self._shard_name())
+        size = self.image_size
+        self._images = np.lib.format.open_memmap(base + '.images.npy', mode='w+', dtype=np.uint8, shape=(self.shard_size, size, size, 3))
+        if self.channels:
+            self._velocity = np.lib.format.open_memmap(base + '.channels.npy', mode='w+', dtype=np.uint8, shape=(self.shard_size, len(self.channels), size, size))
+        else:
+            self._velocity = np.lib.format.open_memmap(base + '.velocity.npy', mode='w+', dtype=np.uint8, shape=(self.shard_size, size, size))
+        self._rows = []
+
+    def append(self, image, velocity, metadata):
+        """
+        Adds one sample. `velocity` is a uint8 grid from quantize_velocity (a (C, 224, 224) stack from quantize
+        with `channels`), `metadata` a dict of index_columns values.
+        """
+        if self._images is None:
+            self._open_shard()
+
+        row = len(self._rows)
+        self._images[row] = image
+        self._velocity[row] = velocity
+        self._rows.append(dict(metadata, shard=self._shard_name(), row=row))
+        self.samples_written += 1
+
+        if len(self._rows) == self.shard_size:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        base = os.path.join(self.directory, self._shard_name())
+        count = len(self._rows)
+
+        self._images.flush()
+        self._velocity.flush()
+        if count < self.shard_size:
+            # Shrink a partly filled final shard so its array length matches the index
+            images, velocity = np.array(self._images[:count]), np.array(self._velocity[:count])
+            self._images = self._velocity = None
+            np.save(base + '.images.npy', images)
+            np.save(base + ('.channels.npy' if self.channels else '.velocity.npy'), velocity)
+
+        tmp_path = base + '.index.csv.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=index_columns)
+            writer.writeheader()
+            writer.writerows(self._rows)
+        os.replace(tmp_path, base + '.index.csv')
+
+        rows = self._rows
+        self._images = self._velocity = None
+        self._rows = []
+        self._shard_number += 1
+
+        if self.on_shard_written:
+            self.on_shard_written(rows)
+
+    def close(self):
+        if self._rows:
+            self._finish_shard()
@@ -0,0 +1,329 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import radar_io
+
+try:
+    import fcntl
+except ImportError:  # Windows: without fcntl only threads of one process are kept in step
+    fcntl = None
+
+cache_directory = 'sweep_cache'
+missing_value = np.iinfo(np.int16).min  # Marks masked gates; quantized values use the rest of the int16 range
+quantized_max = np.iinfo(np.int16).max - 1
+
+class SweepCache:
+    """
+    Cache of decoded sweeps, the tier after archive_cache: once a volume has been decoded, each sweep read
+    from it is stored as compact arrays that later reads load without pyart decoding anything.
+    Entries are keyed by the scan's file name, the last part of its S3 key (e.g. KTLX20130520_200000_V06),
+    which already names the radar and the volume time. Each scan gets a directory holding, per sweep, a
+    JSON header (site, fixed angle and each field's scale and offset), .npy arrays of the ray azimuths,
+    elevations and times and of the gate ranges, and one int16 .npy per field. The .npy files are
+    memory-mapped on load. Files are written atomically with the header last, so a header only ever lists
+    complete arrays. Once the cache is over `max_bytes`, the least recently used scans are evicted.
+    Renders run in forked worker processes, so the running total lives in the directory itself: a `.size`
+    record updated under an flock on `.lock`. When a store takes it past `max_bytes`, the directory is
+    re-scanned, which also counts scans whose records were lost, and the oldest scans are removed.
+    """
+
+    def __init__(self, directory=cache_directory, max_bytes=10 * 1024**3, recover=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(directory, '.lock')
+        self._record_path = os.path.join(directory, '.size')
+
+        os.makedirs(directory, exist_ok=True)
+        if not recover:  # A render worker; the process that configured the cache has already cleaned it up
+            return
+        with self._shared():
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.startswith('.tmp'):
+                    os.remove(path)
+                elif os.path.isdir(path):
+                    for file in os.listdir(path):
+                        if file.startswith('.tmp'):  # Left over from an interrupted write
+                            os.remove(os.path.join(path, file))
+            self._rescan()
+
+    @contextmanager
+    def _shared(self):
+        # Serializes updates of the size record between threads and, through the lock file, processes
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read_record(self):
+        try:
+            with open(self._record_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_record(self, record):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self._record_path)
+
+    def _rescan(self):
+        # Must be called inside _shared(); returns {scan directory: (size, last used)} and rewrites the record
+        entries = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.isdir(path):
+                    entries[path] = (_directory_size(path), os.path.getmtime(path))
+            except OSError:  # Removed while scanning
+                continue
+        self._write_record({'bytes': sum(size for size, _ in entries.values()), 'entries': len(entries)})
+        return entries
+
+    def read_sweeps(self, source, sweeps, fields):
+        """Same as radar_io.read_sweeps, but served from the cache when every sweep and field is stored."""
+        scans = sorted(set(sweeps))
+        scan = _scan_name(source)
+        if scan:
+            radar = self._load(os.path.join(self.directory, scan), scans, fields)
+            if radar is not None:
+                return radar, {sweep: idx for idx, sweep in enumerate(scans)}
+
+        radar, sweep_map = radar_io.read_sweeps(source, sweeps, fields)
+        if scan:
+            self._store(os.path.join(self.directory, scan), radar, sweep_map, fields)
+        return radar, sweep_map
+
+    def _load(self, path, scans, fields):
+        try:
+            headers = []
+            for sweep in scans:
+                with open(os.path.join(path, f"sweep{sweep}.json")) as f:
+                    header = json.load(f)
+                if any(field not in header['fields'] and field not in header['absent'] for field in fields):
+                    raise FileNotFoundError
+                headers.append(header)
+            radar = _build_radar(path, scans, headers, fields)
+        except (OSError, ValueError, KeyError):  # Not cached yet, or evicted by another process while reading
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path)  # Recency is kept on disk, where every process (and the next run) sees it
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return radar
+
+    def _store(self, path, radar, sweep_map, fields):
+        os.makedirs(path, exist_ok=True)
+        size_before = _directory_size(path)
+        site = radar.metadata.get('instrument_name', '')
+        if isinstance(site, bytes):
+            site = site.decode('ascii', 'ignore')
+
+        for sweep, idx in sweep_map.items():
+            sweep_slice = radar.get_slice(idx)
+            header_path = os.path.join(path, f"sweep{sweep}.json")
+            try:
+                with open(header_path) as f:
+                    header = json.load(f)  # Keep the fields stored by earlier reads of this sweep
+            except (OSError, ValueError):
+                header = {'fields': {}, 'absent': []}
+            header.update({
+                'site': site.strip(),
+                'latitude': float(radar.latitude['data'][0]),
+                'longitude': float(radar.longitude['data'][0]),
+                'altitude': float(radar.altitude['data'][0]),
+                'fixed_angle': float(radar.fixed_angle['data'][idx]),
+                'time_units': radar.time['units'],
+            })
+
+            rays = np.stack([radar.azimuth['data'][sweep_slice], radar.elevation['data'][sweep_slice], radar.time['data'][sweep_slice]])
+            _save(path, 'rays', sweep, rays.astype(np.float64))
+            _save(path, 'range', sweep, np.asarray(radar.range['data'], dtype=np.float32))
+            for field in fields:
+                if field not in radar.fields:
+                    header['absent'] = sorted(set(header['absent']) | {field})
+                    continue
+                values, scale, offset = quantize(radar.get_field(idx, field))
+                _save(path, field, sweep, values)
+                meta = {key: value for key, value in radar.fields[field].items() if isinstance(value, str)}
+                header['fields'][field] = dict(meta, scale=scale, offset=offset)
+
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(header, f)
+            os.replace(tmp_path, header_path)
+
+        size_after = _directory_size(path)
+        with self._shared():
+            record = self._read_record()
+            if record is not None:
+                record['bytes'] += size_after - size_before
+                record['entries'] += size_before == 0
+            if record is None or record['bytes'] > self.max_bytes:
+                self._evict(self._rescan(), keep=path)
+            else:
+                self._write_record(record)
+
+    def _evict(self, entries, keep=None):
+        # Must be called inside _shared(), with entries fresh from _rescan()
+        total = sum(size for size, _ in entries.values())
+        count = len(entries)
+        for path, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            count -= 1
+            self.evictions += 1
+        self._write_record({'bytes': total, 'entries': count})
+
+    def stats(self):
+        # Hits, misses and evictions are this process's; entries and bytes are the whole cache's
+        record = self._read_record() or {'bytes': 0, 'entries': 0}
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': record['entries'],
+                'bytes': record['bytes'],
+            }
+
+def quantize(data):
+    """
+    Packs a (masked) float array into int16 with a scale and offset spanning its own range; masked gates
+    become missing_value. Level II moments are already stored as 8 or 16 bit codes, so when the values sit
+    on a regular grid that fits, its step is used as the scale and the packing is lossless.
+    """
+    data = np.ma.masked_invalid(data)
+    levels = np.unique(data.compressed())
+    if len(levels) == 0:
+        offset, scale = 0.0, 1.0
+    else:
+        low, high = float(levels[0]), float(levels[-1])
+        step = float(np.diff(levels).min()) if len(levels) > 1 else 1.0
+        codes = (levels - low) / step
+        if (high - low) / step <= 2 * quantized_max and np.allclose(codes, np.round(codes), atol=1e-3):
+            scale = step
+            offset = low + step * round((high - low) / step / 2)
+        else:
+            offset = (low + high) / 2
+            scale = (high - low) / (2 * quantized_max) or 1.0
+    values = np.round((data.filled(offset) - offset) / scale).astype(np.int16)
+    values[np.ma.getmaskarray(data)] = missing_value
+    return values, scale, offset
+
+def dequantize(values, scale, offset):
+    return np.ma.MaskedArray(values.astype(np.float32) * np.float32(scale) + np.float32(offset), mask=values == missing_value)
+
+def _scan_name(source):
+    # File name of the volume (path or named buffer) without .gz, or None for anonymous buffers
+    name = source if isinstance(source, str) else getattr(source, 'name', None)
+    if not name:
+        return None
+    name = os.path.basename(name)
+    return name[:-3] if name.endswith('.gz') else name
+
+def _directory_size(path):
+    try:
+        return sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+    except OSError:  # Evicted by another process meanwhile
+        return 0
+
+def _save(path, name, sweep, array):
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp', suffix='.npy', dir=path)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, os.path.join(path, f"sweep{sweep}.{name}.npy"))
+
+def _volume_start(time_units):
+    return datetime.strptime(time_units.split('since ')[-1].strip(), '%Y-%m-%dT%H:%M:%SZ')
+
+def _build_radar(path, scans, headers, fields):
+    # Reassembles a pyart Radar like the one radar_io.read_sweeps returns for the same sweeps
+    pyart = radar_io.import_pyart()
+    rays = [np.load(os.path.join(path, f"sweep{sweep}.rays.npy"), mmap_mode='r') for sweep in scans]
+    ranges = [np.load(os.path.join(path, f"sweep{sweep}.range.npy"), mmap_mode='r') for sweep in scans]
+    gate_range = np.array(max(ranges, key=len))  # Sweeps stored by different reads can be trimmed to different lengths
+    ends = np.cumsum([ray.shape[1] for ray in rays])
+    starts = ends - np.array([ray.shape[1] for ray in rays])
+
+    # Ray times are relative to the start of the read that stored them; shift them onto the first sweep's
+    first = _volume_start(headers[0]['time_units'])
+    times = np.concatenate([ray[2] + (_volume_start(header['time_units']) - first) / timedelta(seconds=1) for ray, header in zip(rays, headers)])
+
+    radar_fields = {}
+    for field in fields:
+        stored = [header for header in headers if field in header['fields']]
+        if not stored:
+            continue
+        # Like pyart, a field missing from some of the sweeps is kept, masked on those sweeps
+        data = np.ma.masked_all((int(ends[-1]), len(gate_range)), dtype=np.float32)
+        for sweep, header, start, end in zip(scans, headers, starts, ends):
+            if field not in header['fields']:
+                continue
+            values = np.load(os.path.join(path, f"sweep{sweep}.{field}.npy"), mmap_mode='r')
+            meta = header['fields'][field]
+            data[start:end, :values.shape[1]] = dequantize(values, meta['scale'], meta['offset'])
+        meta = {key: value for key, value in stored[0]['fields'][field].items() if key not in ('scale', 'offset')}
+        radar_fields[field] = dict(meta, data=data)
+
+    header = headers[0]
+    return pyart.core.Radar(
+        time={'data': times, 'units': header['time_units']},
+        _range={'data': gate_range},
+        fields=radar_fields,
+        metadata={'instrument_name': header['site']},
+        scan_type='ppi',
+        latitude={'data': np.array([header['latitude']])},
+        longitude={'data': np.array([header['longitude']])},
+        altitude={'data': np.array([header['altitude']])},
+        sweep_number={'data': np.arange(len(scans), dtype=np.int32)},
+        sweep_mode={'data': np.array([b'azimuth_surveillance'] * len(scans))},
+        fixed_angle={'data': np.array([h['fixed_angle'] for h in headers], dtype=np.float32)},
+        sweep_start_ray_index={'data': starts.astype(np.int32)},
+        sweep_end_ray_index={'data': (ends - 1).astype(np.int32)},
+        azimuth={'data': np.concatenate([ray[0] for ray in rays])},
+        elevation={'data': np.concatenate([ray[1] for ray in rays]).astype(np.float32)},
+    )
+
+# Off until configure() is called; read_sweeps then decodes every volume as before
+default_cache = None
+
+def configure(directory=cache_directory, max_bytes=10 * 1024**3):
+    global default_cache
+    default_cache = SweepCache(directory, max_bytes)
+    return default_cache
+
+def settings():
+    # Passed to render worker processes so they use the same cache; None while it is off
+    return None if default_cache is None else (default_cache.directory, default_cache.max_bytes)
+
+def configure_worker(worker_settings):
+    global default_cache
+    default_cache = None if worker_settings is None else SweepCache(*worker_settings, recover=False)
+
+def read_sweeps(source, sweeps, fields):
+    if default_cache is None:
+        return radar_io.read_sweeps(source, sweeps, fields)
+    return default_cache.read_sweeps(source, sweeps, fields)
@@ -0,0 +1,134 @@
+import bz2
+import struct
+from datetime import datetime
+
+import numpy as np
+
+import radar_io
+
+# Record layouts come from pyart's reader, so the synthetic files follow exactly what it parses.
+# import_pyart() does the first, banner-printing import of pyart; the submodule import below is then quiet
+radar_io.import_pyart()
+from pyart.io.nexrad_level2 import (
+    MSG_HEADER, MSG_31, MSG_5, MSG_5_ELEV, VOLUME_DATA_BLOCK, ELEVATION_DATA_BLOCK,
+    RADIAL_DATA_BLOCK, GENERIC_DATA_BLOCK, RECORD_SIZE,
+)
+
+# Lowest cuts of VCP 212, the precipitation pattern most tornado scans use
+vcp_212_angles = [0.5, 0.9, 1.3, 1.8, 2.4, 3.1, 4.0, 5.1, 6.4, 8.0, 10.0, 12.5, 15.6, 19.5]
+
+ctm_size = 12  # Zeroed legacy header in front of every message
+radials_per_record = 120  # Radials per compressed record in the NOAA archive
+
+def _pack(structure, **values):
+    fmt = '>' + ''.join(code for _, code in structure)
+    args = []
+    for name, code in structure:
+        value = values.get(name, 0)
+        if code.endswith('s') and not isinstance(value, bytes):
+            value = b'' if value == 0 else str(value).encode('ascii')
+        args.append(value)
+    return struct.pack(fmt, *args)
+
+def _size(structure):
+    return struct.calcsize('>' + ''.join(code for _, code in structure))
+
+def _message(msg_type, body, date, ms, fixed_size=False):
+    # size counts halfwords from the message header on; fixed-size messages fill a whole 2432 byte record
+    if fixed_size:
+        body = body.ljust(RECORD_SIZE - ctm_size - _size(MSG_HEADER), b'\0')
+    header = _pack(MSG_HEADER, size=(_size(MSG_HEADER) + len(body)) // 2, channels=8, type=msg_type, date=date, ms=ms, segments=1, seg_num=1)
+    return b'\0' * ctm_size + header + body
+
+def _vcp_message(angles, date, ms):
+    cuts = b''.join(
+        _pack(MSG_5_ELEV, elevation_angle=int(round(angle / 360.0 * 65536)) & 0xFFFF, super_resolution=11)
+        for angle in angles
+    )
+    header = _pack(MSG_5, msg_size=(_size(MSG_5) + len(cuts)) // 2, pattern_type=2, pattern_number=212, num_cuts=len(angles), doppler_vel_res=2, pulse_width=2)
+    return _message(5, header + cuts, date, ms, fixed_size=True)
+
+def _moment_block(name, data, first_gate, gate_spacing, scale, offset):
+    header = _pack(GENERIC_DATA_BLOCK, block_type=b'D', data_name=name.ljust(3).encode('ascii'), ngates=len(data), first_gate=first_gate, gate_spacing=gate_spacing, word_size=8, scale=scale, offset=offset)
+    return header + data.astype('>u1').tobytes()
+
+def _fields(n_rays, ref_gates, vel_gates, elevation, rng):
+    """Storm-like reflectivity and velocity for one sweep, as packed uint8 gate values."""
+    azimuths = np.radians(np.arange(n_rays) * 360.0 / n_rays)[:, np.newaxis]
+    ref_range = (2.125 + 0.25 * np.arange(ref_gates))[np.newaxis, :]
+    vel_range = (2.125 + 0.25 * np.arange(vel_gates))[np.newaxis, :]
+
+    # A few reflectivity cells plus noise, masked below 5 dBZ like a clear-air cutoff
+    dbz = np.zeros((n_rays, ref_gates))
+    for _ in range(4):
+        az0, r0, size = rng.uniform(0, 2 * np.pi), rng.uniform(20, 200), rng.uniform(10, 40)
+        x = ref_range * np.sin(azimuths) - r0 * np.sin(az0)
+        y = ref_range * np.cos(azimuths) - r0 * np.cos(az0)
+        dbz = np.maximum(dbz, 60 * np.exp(-(x**2 + y**2) / (2 * size**2)))
+    dbz += rng.normal(0, 2, dbz.shape) - elevation
+    ref = np.where(dbz < 5, 0, np.clip(np.round(dbz * 2 + 66), 2, 255))
+
+    # Environmental wind plus a rotation couplet, folded at a 30 m/s Nyquist velocity
+    x = vel_range * np.sin(azimuths) - 60
+    y = vel_range * np.cos(azimuths) - 60
+    radius = np.hypot(x, y)
+    tangential = 40 * np.where(radius < 3, radius / 3, 3 / np.maximum(radius, 1e-6))
+    radial = 15 * np.cos(azimuths - np.radians(225)) + tangential * (x * np.cos(azimuths) - y * np.sin(azimuths)) / np.maximum(radius, 1e-6)
+    radial = (radial + rng.normal(0, 1, radial.shape) + 30) % 60 - 30
+    vel = np.clip(np.round(radial * 2 + 129), 2, 255)
+    vel[:, (vel_range[0] > 230)] = 0
+
+    return ref.astype(np.uint8), vel.astype(np.uint8)
+
+def synthetic_volume(radar_code='KTLX', scan_time=None, lat=35.333, lon=-97.278, n_sweeps=8, n_rays=720, ref_gates=1832, vel_gates=1192, seed=0):
+    """
+    Builds a Level II archive file (the uncompressed `_V06` form) that pyart.io.read_nexrad_archive reads
+    like a real volume: an AR2V volume header followed by bzip2 records with the control words NOAA uses.
+    Sweeps cycle through the lowest VCP 212 angles and each carries reflectivity and velocity at the usual
+    super-resolution sizes, filled with storm-like fields. Returns the file contents as bytes.
+    """
+    scan_time = scan_time or datetime(2013, 5, 20, 20, 0, 0)
+    rng = np.random.default_rng(seed)
+    date = (scan_time - datetime(1970, 1, 1)).days + 1
+    start_ms = (scan_time.hour * 3600 + scan_time.minute * 60 + scan_time.second) * 1000
+    angles = [vcp_212_angles[i % len(vcp_212_angles)] for i in range(n_sweeps)]
+
+    volume_header = _pack(
+        (('tape', '9s'), ('extension', '3s'), ('date', 'I'), ('time', 'I'), ('icao', '4s')),
+        tape=b'AR2V0006.', extension=b'001', date=date, time=start_ms, icao=radar_code.encode('ascii'),
+    )
+
+    # Metadata record first, then the radials
+    records = [[_vcp_message(angles, date, start_ms)]]
+    vol = _pack(VOLUME_DATA_BLOCK, block_type=b'R', data_name=b'VOL', lrtup=44, version_major=1, lat=lat, lon=lon, height=370, feedhorn_height=20, vcp=212)
+    elv = _pack(ELEVATION_DATA_BLOCK, block_type=b'R', data_name=b'ELV', lrtup=12)
+    rad = _pack(RADIAL_DATA_BLOCK, block_type=b'R', data_name=b'RAD', lrtup=20, unambig_range=4660, nyquist_vel=3000)
+
+    radials = []
+    ms = start_ms
+    for sweep, angle in enumerate(angles):
+        ref, vel = _fields(n_rays, ref_gates, vel_gates, angle, rng)
+        for ray in range(n_rays):
+            blocks = [vol, elv, rad, _moment_block('REF', ref[ray], 2125, 250, 2.0, 66.0), _moment_block('VEL', vel[ray], 2125, 250, 2.0, 129.0)]
+            pointers = []
+            offset = _size(MSG_31)
+            for block in blocks:
+                pointers.append(offset)
+                offset += len(block)
+            status = 0 if ray == 0 else (2 if ray == n_rays - 1 else 1)
+            header = _pack(
+                MSG_31, id=radar_code.encode('ascii'), collect_ms=ms, collect_date=date, azimuth_number=ray + 1,
+                azimuth_angle=(ray + 0.5) * 360.0 / n_rays, radial_length=offset, azimuth_resolution=1 if n_rays == 720 else 2,
+                radial_spacing=status, elevation_number=sweep + 1, elevation_angle=angle, block_count=len(blocks),
+                **{f'block_pointer_{i + 1}': pointer for i, pointer in enumerate(pointers)}
+            )
+            radials.append(_message(31, header + b''.join(blocks), date, ms))
+            ms += 25
+
+    records += [radials[i:i + radials_per_record] for i in range(0, len(radials), radials_per_record)]
+
+    out = [volume_header]
+    for record in records:
+        compressed = bz2.compress(b''.join(record))
+        out.append(struct.pack('>i', len(compressed)) + compressed)
+    return b''.join(out)
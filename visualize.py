@@ -1,42 +1,66 @@
 import os
-import sys
 import numpy as np
-import cartopy.crs as ccrs
-import matplotlib.pyplot as plt
 from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import raster
+import geometry_cache
+import radar_io
+import sweep_cache
+import shard_writer
+import instrumentation
+import products as products_module
 
-backup = sys.stdout
-sys.stdout = open(os.devnull, 'w')
-import pyart
-sys.stdout = backup
+# pyart, matplotlib and cartopy are only imported once something is rendered (see preload)
 
-def visualize_radar_data(filename, image_directory, tornado_lat, tornado_lon, debug_mode=False):
+def preload(engine='matplotlib'):
+    # Imports the rendering libraries up front, e.g. before forking render workers so they share them
+    radar_io.import_pyart()
+    if engine == 'matplotlib':
+        import matplotlib.pyplot
+        import cartopy.crs
+
+def _source_name(source):
+    # Radar data is either a path or an in-memory buffer carrying the original file name
+    return source if isinstance(source, str) else getattr(source, 'name', 'buffer')
+
+def visualize_radar_data(filename, image_directory, tornado_lat, tornado_lon, debug_mode=False, raise_errors=False, engine='matplotlib', return_sample=False, event_id=None, samples_per_scan=1, rotate=False, products=None):
     # This function reads the radar data using pyart and creates a visualization for velocity.
     # It will then randomly offset the tornado's location by up to 25 miles in any direction.
     # It then saves this visualization to the specified image directory, focused on the tornado's location.
     # Finally, it crops the image to a square and resizes it to 224x224.
+    # `filename` may also be a file-like object holding the decompressed volume (see download.py's stream mode).
+    # engine='numpy' skips matplotlib and maps the gates straight onto the 224x224 image (see raster.py).
+    # With return_sample set, nothing is saved; the sample is returned as a dict with the RGB image, the
+    # quantized velocity grid and the random offsets (used for shard output, always with the numpy engine).
+    # event_id (see main.event_keys, unique per event row) is added to the image name so events sharing a scan don't overwrite each other's images.
+    # With samples_per_scan above 1, that many samples with independent offsets are cut from one rasterization
+    # of the sweep, always with the numpy engine. They are saved as <scan>_<event>_<k>_velocity.png, or returned
+    # as a list of sample dicts with return_sample. With rotate set, every sample, a single one included, also
+    # gets a random rotation, which likewise uses the numpy engine.
+    # Decoded sweeps come from sweep_cache.py when it is configured, skipping the pyart decode for scans read before.
+    # `products` lists the (field, sweep) pairs to render (see products.py); anything but the default also
+    # uses the numpy engine, saves one PNG per product and returns the quantized products as 'channels'.
+    # With raise_errors set, failures are raised instead of printed so callers can collect them.
+    # Each step is timed as an instrumentation stage when metrics are enabled.
 
     try:
-        # Reading the radar data
-        radar = pyart.io.read_nexrad_archive(filename)
+        # Reading the radar data, decoding only the sweeps and fields we render
+        products = [tuple(product) for product in products] if products else products_module.default_products
+        with instrumentation.stage('decode', event_id=event_id, source=_source_name(filename)):
+            radar, sweep_map = sweep_cache.read_sweeps(filename, [sweep for _, sweep in products], [field for field, _ in products])
 
-        # Check if the velocity field is present in the radar data
-        if 'velocity' not in radar.fields:
-            print(f"Error processing {filename}. Velocity data is missing.")
-            return
+        # Check if every field is present in the radar data
+        for field, _ in products:
+            if field not in radar.fields:
+                message = f"{field.replace('_', ' ').capitalize()} data is missing."
+                if raise_errors:
+                    raise ValueError(message)
+                print(f"Error processing {_source_name(filename)}. {message}")
+                return
 
         # Extracting the data from radar object
-        sweep = 3
-        data = radar.get_field(sweep, 'velocity')
-        x, y, _ = radar.get_gate_x_y_z(sweep)
-        x /= 1000.0  # Convert to km
-        y /= 1000.0  # Convert to km
-
-        # Convert Cartesian x and y to latitudes and longitudes
-        lon_offset = x / (111.0 * np.cos(np.radians(radar.latitude['data'][0])))
-        lat_offset = y / 111.0
-        actual_lons = radar.longitude['data'][0] + lon_offset
-        actual_lats = radar.latitude['data'][0] + lat_offset
+        sweep = sweep_map[products[0][1]]
+        data = radar.get_field(sweep, products[0][0])
 
         # Randomly offset the tornado's location by up to 25 miles
         max_offset_miles = 20
@@ -50,13 +74,36 @@ def visualize_radar_data(filename, image_directory, tornado_lat, tornado_lon, de
         random_tornado_lon = tornado_lon + random_lon_offset
 
         # Setting up file names for saving
-        base_filename = os.path.basename(filename).split('.')[0]
-        vel_image_name = f"{base_filename}_velocity.png"
+        base_filename = os.path.basename(_source_name(filename)).split('.')[0]
+        vel_image_name = f"{base_filename}_{event_id}_velocity.png" if event_id is not None else f"{base_filename}_velocity.png"
+
+        if engine == 'numpy' or return_sample or samples_per_scan > 1 or rotate or products != products_module.default_products:
+            # Every further sample gets its own offset, and every sample a rotation with rotate set
+            offsets = [(random_lat_offset, random_lon_offset, 0.0)]
+            for _ in range(samples_per_scan - 1):
+                offsets.append((np.random.uniform(-lat_offset_degrees, lat_offset_degrees), np.random.uniform(-lon_offset_degrees, lon_offset_degrees), 0.0))
+            if rotate:
+                offsets = [(lat_offset, lon_offset, np.random.uniform(0.0, 360.0)) for lat_offset, lon_offset, _ in offsets]
+
+            stem = vel_image_name[:-len('_velocity.png')]
+            samples = _numpy_samples(radar, sweep_map, products, tornado_lat, tornado_lon, offsets, image_directory, stem, return_sample, event_id)
+            if return_sample:
+                return samples if samples_per_scan > 1 else samples[0]
+            return
+
+        import matplotlib.pyplot as plt
+        import cartopy.crs as ccrs
+        pyart = radar_io.import_pyart()
 
-        fig, ax = plt.subplots(figsize=(10, 10), subplot_kw={'projection': ccrs.PlateCarree()})
-        vmin, vmax = -60, 60
+        # Gate latitudes and longitudes, shared between scans with the same site and sweep layout
+        with instrumentation.stage('geometry', event_id=event_id):
+            actual_lats, actual_lons = geometry_cache.gate_lat_lon(radar, sweep)
 
-        cax = ax.pcolormesh(actual_lons, actual_lats, data, vmin=vmin, vmax=vmax, cmap=pyart.graph.cm.NWSVel)
+        with instrumentation.stage('plot', event_id=event_id):
+            fig, ax = plt.subplots(figsize=(10, 10), subplot_kw={'projection': ccrs.PlateCarree()})
+            vmin, vmax = -60, 60
+
+            cax = ax.pcolormesh(actual_lons, actual_lats, data, vmin=vmin, vmax=vmax, cmap=pyart.graph.cm.NWSVel)
 
         # Calculate the buffer in degrees for a 50x50 mile square around the tornado's location
         miles_per_degree = 69.0
@@ -77,11 +124,12 @@ def visualize_radar_data(filename, image_directory, tornado_lat, tornado_lon, de
             ax.axis('off')
 
         # Save the image
-        plt.savefig(os.path.join(image_directory, vel_image_name), bbox_inches='tight', pad_inches=0)
-        plt.close()
+        with instrumentation.stage('savefig', event_id=event_id):
+            plt.savefig(os.path.join(image_directory, vel_image_name), bbox_inches='tight', pad_inches=0)
+            plt.close()
 
         image_path = os.path.join(image_directory, vel_image_name)
-        with Image.open(image_path) as img:
+        with instrumentation.stage('resize', event_id=event_id), Image.open(image_path) as img:
             width, height = img.size
             new_size = min(width, height)
 
@@ -92,14 +140,145 @@ def visualize_radar_data(filename, image_directory, tornado_lat, tornado_lon, de
 
             img_cropped = img.crop((left, top, right, bottom))
 
-            img_resized = img_cropped.resize((224, 224), Image.ANTIALIAS)
+            img_resized = img_cropped.resize((224, 224), Image.LANCZOS)
 
             img_resized.save(image_path)
 
     except Exception as e:
-        print(f"Error processing {filename}. Error: {e}")
+        if raise_errors:
+            raise
+        print(f"Error processing {_source_name(filename)}. Error: {e}")
+
+def _numpy_samples(radar, sweep_map, products, tornado_lat, tornado_lon, offsets, image_directory, stem, return_sample, event_id):
+    # Maps the sweeps straight onto pixels instead of drawing a figure, one sample per (lat offset, lon offset,
+    # rotation) in `offsets`, with one channel per product. The square crop of the matplotlib figure spans the
+    # latitude buffer in both directions. Every product is rasterized once and fields on the same sweep share
+    # one pixel-to-gate mapping. A single unrotated sample is rasterized directly onto the 224x224 output.
+    # Otherwise the grid is centred on the tornado, wide enough for every crop, and keeps the output's pixel
+    # size so an unrotated crop lands on whole grid pixels; the samples are then cut from it.
+    half_extent = 30.0 / 69.0
+    single = len(offsets) == 1 and offsets[0][2] == 0.0
+    if single:
+        center_lat, center_lon = tornado_lat + offsets[0][0], tornado_lon + offsets[0][1]
+        grid_size, grid_half_extent = raster.image_size, half_extent
+    else:
+        rotated = any(rotation for _, _, rotation in offsets)
+        needed = half_extent * (np.sqrt(2.0) if rotated else 1.0) + max(max(abs(lat), abs(lon)) for lat, lon, _ in offsets)
+        center_lat, center_lon = tornado_lat, tornado_lon
+        grid_size = 2 * int(np.ceil(raster.image_size * needed / half_extent / 2))
+        grid_half_extent = half_extent * grid_size / raster.image_size
+
+    with instrumentation.stage('rasterize', event_id=event_id):
+        grids = []
+        indices_by_sweep = {}
+        for field, volume_sweep in products:
+            sweep = sweep_map[volume_sweep]
+            if sweep not in indices_by_sweep:
+                sweep_slice = radar.get_slice(sweep)
+                indices_by_sweep[sweep] = raster.gate_indices(
+                    radar.azimuth['data'][sweep_slice], radar.range['data'], radar.elevation['data'][sweep_slice].mean(),
+                    radar.latitude['data'][0], radar.longitude['data'][0], center_lat, center_lon, grid_half_extent, grid_size
+                )
+            grids.append(raster.sample_field(radar.get_field(sweep, field), indices_by_sweep[sweep]).ravel())
+
+    cm = radar_io.import_pyart().graph.cm
+    scales = [products_module.field_scales[field] for field, _ in products]
+    luts = [raster.colormap_lut(getattr(cm, cmap)) for cmap, _, _ in scales]
+    names = products_module.channel_names(products)
+
+    samples = []
+    for k, (lat_offset, lon_offset, rotation) in enumerate(offsets):
+        if single:
+            values = [grid.reshape(grid_size, grid_size) for grid in grids]
+        else:
+            with instrumentation.stage('crop', event_id=event_id):
+                crop = raster.crop_indices(grid_size, grid_half_extent, half_extent, lat_offset, lon_offset, rotation)
+                values = [grid[crop] for grid in grids]
+
+        _, vmin, vmax = scales[0]
+        sample = {
+            'image': raster.colorize(values[0], luts[0], vmin, vmax),
+            'lat_offset': lat_offset,
+            'lon_offset': lon_offset,
+            'rotation': rotation,
+        }
+        if products == products_module.default_products:
+            sample['velocity'] = shard_writer.quantize_velocity(values[0])
+        else:
+            sample['channels'] = np.stack([shard_writer.quantize(v, vmin, vmax) for v, (_, vmin, vmax) in zip(values, scales)])
+        samples.append(sample)
+
+        if not return_sample:
+            # One PNG per product, numbered when the scan yields several samples
+            prefix = f"{stem}_{k}" if len(offsets) > 1 else stem
+            with instrumentation.stage('encode', event_id=event_id):
+                Image.fromarray(sample['image']).save(os.path.join(image_directory, f"{prefix}_{names[0]}.png"))
+                for name, v, lut, (_, vmin, vmax) in list(zip(names, values, luts, scales))[1:]:
+                    Image.fromarray(raster.colorize(v, lut, vmin, vmax)).save(os.path.join(image_directory, f"{prefix}_{name}.png"))
+
+    return samples
+
+def _init_render_worker(instrumentation_settings=(None, 0, instrumentation.profile_directory), sweep_cache_settings=None, geometry_cache_settings=(None, 32)):
+    # Runs once per worker process. pyart, matplotlib and cartopy were already imported by preload()
+    # in the parent before it forked, so only per-process state is set up here: a non-interactive backend, a fresh
+    # random seed so forked workers don't all pick the same tornado offsets, and the parent's
+    # instrumentation and cache settings, so workers record their stages into the same metrics file and use
+    # the same caches. Settings are passed in rather than inherited from the parent's globals, which only
+    # works with fork.
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    np.random.seed()
+    instrumentation.configure_worker(instrumentation_settings)
+    sweep_cache.configure_worker(sweep_cache_settings)
+    geometry_cache.configure_worker(geometry_cache_settings)
+
+def render_task(task):
+    filename, image_directory, tornado_lat, tornado_lon, options = task
+    try:
+        with instrumentation.profile(options.get('event_id'), _source_name(filename)):
+            sample = visualize_radar_data(filename, image_directory, tornado_lat, tornado_lon, raise_errors=True, **options)
+        return _source_name(filename), None, sample
+    except Exception as e:
+        # Exceptions don't always pickle, so only the message crosses the process boundary
+        return _source_name(filename), f"{type(e).__name__}: {e}", None
+
+def render_pool(workers):
+    # Worker processes for render_task; call preload() first so they inherit the rendering libraries
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker, initargs=(instrumentation.settings(), sweep_cache.settings(), geometry_cache.settings()))
+
+def visualize_files(tasks, workers=1, on_complete=None):
+    """
+    Renders many radar files, spreading the work across `workers` processes.
+    `tasks` is a list of (filename, image_directory, tornado_lat, tornado_lon, options) tuples, where options
+    is a dict of extra keyword arguments for visualize_radar_data (debug_mode, engine, return_sample, ...).
+    Returns a list of (file name, error, sample) tuples in the same order as `tasks`; error is None on success
+    and sample is None unless return_sample was set.
+    """
+    # Import the renderers once here, so forked workers inherit them instead of each importing them again
+    options = tasks[0][4] if tasks else {}
+    preload('numpy' if options.get('return_sample') else options.get('engine', 'matplotlib'))
+
+    if workers <= 1:
+        results = []
+        for task in tasks:
+            results.append(render_task(task))
+            if on_complete:
+                on_complete()
+        return results
+
+    results = [None] * len(tasks)
+    with render_pool(workers) as executor:
+        futures = {executor.submit(render_task, task): idx for idx, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as e:  # A worker died (e.g. killed for memory)
+                results[idx] = (_source_name(tasks[idx][0]), f"{type(e).__name__}: {e}", None)
+            if on_complete:
+                on_complete()
+
+    return results
 
-# Adjust this if your directory is elsewhere
+# Adjust this if your directory is elsewhere. Created by main.py when PNGs are written.
 image_directory = 'radar_images'
-if not os.path.exists(image_directory):
-    os.makedirs(image_directory)